@@ -0,0 +1,166 @@
+import click
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from functools import wraps
+
+from click.testing import CliRunner
+
+from standin import StandInServer
+
+
+#### Times search, export, import, bind fan-out, publish and stats against bench/standin.py ####
+#### e.g. python bench/benchmark.py --sizes 10,1000,10000 --concurrency 16 --json results.json ####
+
+ORG_ID = 'org'
+ENV_ID = 'env'
+REGION = 'us-east-1'
+BROKER_COMMANDS = ('publish',)   # authenticated with client app credentials instead of a username and password
+
+
+class RequestTimer:
+    """Records the duration of every mq admin API request, retries included"""
+
+    def __init__(self):
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def wrap(self, fn):
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(time.perf_counter() - start)
+        return timed
+
+    def wrapAsync(self, fn):
+        @wraps(fn)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.add(time.perf_counter() - start)
+        return timed
+
+    def add(self, duration):
+        with self.lock:
+            self.durations.append(duration)
+
+    def reset(self):
+        with self.lock:
+            durations, self.durations = self.durations, []
+        return durations
+
+
+def percentile(values, fraction):
+    """This function returns the nearest-rank percentile of values, None when there are none"""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def runCommand(mq, args):
+    """This function runs an mq command in process and raises when it fails. The retry budget and rate limiter are per run, as in a new process"""
+
+    mq._retryBudget = None
+    mq._rateLimiter = None
+    credentials = ['--client-id', 'bench', '--client-secret', 'bench'] if args[0] in BROKER_COMMANDS else ['--username', 'bench', '--password', 'bench']
+    result = CliRunner().invoke(mq.cli, args[:1] + credentials + ['--region', REGION,
+        '--organization-id', ORG_ID, '--environment-id', ENV_ID] + args[1:])
+    if result.exit_code != 0:
+        raise Exception(' '.join(args[:1]) + ' failed: ' + (str(result.exception) if result.exception else result.output[-500:]))
+    return result.output
+
+
+def scenarios(size, workDir, concurrency, backend):
+    """This function returns the (name, destinations reset before, command) scenarios of a dataset size, in run order.
+    import runs against an empty environment with the files written by export. publish sends <size> messages to a queue"""
+
+    exportPath = os.path.join(workDir, 'export-' + str(size))
+    queueCount = size - size // 10
+    queueNames = ','.join('queue-%05d' % i for i in range(queueCount))
+    messagesPath = os.path.join(workDir, 'messages-' + str(size) + '.ndjson')
+    with open(messagesPath, 'w') as messages:
+        for i in range(size):
+            messages.write(json.dumps({'body': json.dumps({'order': i}), 'properties': {'contentType': 'application/json'}}) + '\n')
+    return [
+        ('search', size, ['search', '--no-cache']),
+        ('export', size, ['export', '--conf-path', exportPath, '--concurrency', str(concurrency), '--backend', backend]),
+        ('import', 0, ['import', '--conf-path', exportPath, '--concurrency', str(concurrency), '--backend', backend]),
+        ('bind fan-out', size, ['bind-queue', '--exchange-name', 'exchange-00000', '--queue-name', queueNames,
+            '--concurrency', str(concurrency), '--backend', backend]),
+        ('publish', size, ['publish', '--destination', 'queue-00001', '--file', messagesPath, '--concurrency', str(concurrency)]),
+        ('stats', size, ['stats', '--no-cache', '--format', 'ndjson', '--concurrency', str(concurrency)]),
+    ]
+
+
+@click.command()
+@click.option('--sizes', 'sizes', help='Comma-separated dataset sizes, in destinations', default='10,1000,10000')
+@click.option('--concurrency', 'concurrency', help='--concurrency of export, import and bind-queue', default=8, type=click.IntRange(min=1))
+@click.option('--backend', 'backend', help='--backend of export, import and bind-queue', default='threads', type=click.Choice(['threads', 'async']))
+@click.option('--latency', 'latency', help='Seconds added by the stand-in to every request', default=0.005, type=float)
+@click.option('--jitter', 'jitter', help='Random +/- seconds added to the latency', default=0.0, type=float)
+@click.option('--throttle-rate', 'throttleRate', help='Fraction of the stand-in requests answered with 429', default=0.0, type=click.FloatRange(0, 1))
+@click.option('--retry-after', 'retryAfter', help='Retry-After seconds of the 429 responses', default=0.1, type=float)
+@click.option('--repeat', 'repeat', help='Runs of every scenario, the fastest one is reported', default=1, type=click.IntRange(min=1))
+@click.option('--json', 'jsonPath', help='Also write the results to this file, to compare runs', required=False, type=click.Path())
+def main(sizes, concurrency, backend, latency, jitter, throttleRate, retryAfter, repeat, jsonPath):
+    """This command times mq commands against the local stand-in and reports wall time, throughput and request latency p50/p99"""
+
+    workDir = tempfile.mkdtemp(prefix='mq-bench-')
+    os.environ.update({'XDG_CACHE_HOME': os.path.join(workDir, 'cache'), 'MQ_TOKEN_CACHE': 'none', 'MQ_INDEX_TTL': '0'})
+
+    with StandInServer(0, 0, latency, jitter, throttleRate, retryAfter) as standIn:
+        os.environ['MQ_ANYPOINT_URL'] = standIn.url
+        os.environ['MQ_BROKER_URL'] = standIn.url + '/broker/{region}'
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        import mq
+
+        timer = RequestTimer()
+        mq.httpRequest = timer.wrap(mq.httpRequest)
+        mq.asyncHttpRequest = timer.wrapAsync(mq.asyncHttpRequest)
+
+        results = []
+        print('%-14s %8s %10s %10s %12s %10s %10s %8s' % ('scenario', 'size', 'seconds', 'requests', 'requests/s', 'p50 ms', 'p99 ms', '429s'))
+        try:
+            for size in [int(value) for value in sizes.split(',')]:
+                for name, destinations, args in scenarios(size, workDir, concurrency, backend):
+                    best = None
+                    for run in range(repeat):
+                        standIn.reset(destinations)
+                        if name == 'export':
+                            shutil.rmtree(args[2], ignore_errors=True)
+                        timer.reset()
+                        start = time.perf_counter()
+                        runCommand(mq, args)
+                        seconds = time.perf_counter() - start
+                        durations = timer.reset()
+                        if best is None or seconds < best['seconds']:
+                            best = {'scenario': name, 'size': size, 'concurrency': concurrency, 'backend': backend,
+                                'seconds': round(seconds, 3), 'requests': len(durations),
+                                'requestsPerSecond': round(len(durations) / seconds, 1) if seconds else None,
+                                'p50Ms': round(percentile(durations, 0.5) * 1000, 2) if durations else None,
+                                'p99Ms': round(percentile(durations, 0.99) * 1000, 2) if durations else None,
+                                'throttled': standIn.throttled}
+                    results.append(best)
+                    print('%-14s %8d %10.3f %10d %12s %10s %10s %8d' % (name, size, best['seconds'], best['requests'],
+                        best['requestsPerSecond'], best['p50Ms'], best['p99Ms'], best['throttled']))
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    if jsonPath:
+        with open(jsonPath, 'w') as outfile:
+            outfile.write(json.dumps({'latency': latency, 'jitter': jitter, 'throttleRate': throttleRate, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
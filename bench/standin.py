@@ -0,0 +1,372 @@
+import click
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+#### Local stand-in for the Anypoint login, accounts, MQ admin, MQ stats and MQ broker APIs used by mq.py ####
+#### Point mq at it with MQ_ANYPOINT_URL=http://127.0.0.1:<port> and MQ_BROKER_URL=http://127.0.0.1:<port>/broker/{region} ####
+
+ADMIN_PATH = re.compile(r'^/mq/admin/api/v1/organizations/([^/]+)/environments/([^/]+)/regions/([^/]+)(/.*)$')
+DESTINATION_PATH = re.compile(r'^/destinations/(queues|exchanges)/([^/]+)(/messages)?$')
+BINDING_PATH = re.compile(r'^/bindings/exchanges/([^/]+)(?:/queues/([^/]+))?$')
+ENVIRONMENTS_PATH = re.compile(r'^/accounts/api/organizations/([^/]+)/environments$')
+STATS_PATH = re.compile(r'^/mq/stats/api/v1/organizations/([^/]+)/environments/([^/]+)/regions/([^/]+)/(queues|exchanges)/([^/]+)$')
+BROKER_PATH = re.compile(r'^/broker/([^/]+)/api/v1(/.*)$')
+MESSAGES_PATH = re.compile(r'^/organizations/([^/]+)/environments/([^/]+)/destinations/([^/]+)/messages(?:/([^/]+)/locks/([^/]+))?$')
+
+
+def dataset_util(destinations, bindingsPerExchange=2):
+    """This function returns a reproducible dataset of about <destinations> destinations: one exchange every 10 destinations,
+    each one bound to <bindingsPerExchange> queues, and one dead letter queue every 100 queues"""
+
+    queues = {}
+    exchanges = {}
+    bindings = {}
+    exchangeCount = destinations // 10
+    queueCount = destinations - exchangeCount
+    for i in range(queueCount):
+        queueId = 'queue-%05d' % i
+        queue = {'type': 'queue', 'queueId': queueId, 'fifo': i % 7 == 0, 'defaultTtl': 604800000, 'defaultLockTtl': 120000,
+            'encrypted': False, 'defaultDeliveryDelay': 0}
+        if i % 100 == 0:
+            queue['deadLetterSources'] = []
+        else:
+            queue['deadLetterQueueId'] = 'queue-%05d' % (i - i % 100)
+            queue['maxDeliveries'] = 10
+            queues[queue['deadLetterQueueId']]['deadLetterSources'].append(queueId)
+        queues[queueId] = queue
+    for i in range(exchangeCount):
+        exchangeId = 'exchange-%05d' % i
+        exchanges[exchangeId] = {'type': 'exchange', 'exchangeId': exchangeId, 'encrypted': False}
+        bindings[exchangeId] = set('queue-%05d' % ((i * bindingsPerExchange + j) % queueCount) for j in range(bindingsPerExchange)) if queueCount else set()
+
+    return {'queues': queues, 'exchanges': exchanges, 'bindings': bindings}
+
+
+class StandInServer:
+    """Threaded HTTP server emulating the Anypoint APIs used by mq.py. Every organization, environment and region gets its own
+    copy of the dataset. latency (seconds, +/- jitter) is added to every request and throttleRate of the requests answer 429"""
+
+    def __init__(self, port=0, destinations=100, latency=0.0, jitter=0.0, throttleRate=0.0, retryAfter=1, environments=('env',)):
+        self.destinations = destinations
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleRate = throttleRate
+        self.retryAfter = retryAfter
+        self.environments = list(environments)
+        self.stores = {}
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def reset(self, destinations=None):
+        """Drops every store, the next request of a region and environment gets a fresh dataset of <destinations> destinations"""
+
+        with self.lock:
+            if destinations is not None:
+                self.destinations = destinations
+            self.stores = {}
+            self.requests = 0
+            self.throttled = 0
+
+    def store(self, key):
+        with self.lock:
+            if key not in self.stores:
+                self.stores[key] = dataset_util(self.destinations)
+                self.stores[key]['version'] = 0
+                self.stores[key]['messages'] = {}
+                self.stores[key]['counters'] = {}
+            return self.stores[key]
+
+    def count(self, store, name, counter, value):
+        """Adds to a stats counter of a destination, the caller holds the lock"""
+
+        counters = store['counters'].setdefault(name, {})
+        counters[counter] = counters.get(counter, 0) + value
+
+    def admit(self):
+        """Counts a request, sleeps the configured latency and returns whether it is throttled"""
+
+        with self.lock:
+            self.requests += 1
+            throttled = self.random.random() < self.throttleRate
+            self.throttled += throttled
+            delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            time.sleep(delay)
+        return throttled
+
+    def handler(self):
+        standIn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=None, headers=None):
+                data = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length) if length else b''
+                # The broker authorize request is form encoded #
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    return dict(parse_qsl(data.decode()))
+                return json.loads(data or b'{}')
+
+            def dispatch(self, method):
+                payload = self.body() if method in ('POST', 'PUT', 'PATCH', 'DELETE') else None
+                if standIn.admit():
+                    return self.send(429, {}, {'Retry-After': str(standIn.retryAfter)})
+
+                path, _, query = self.path.partition('?')
+                self.query = dict(parse_qsl(query))
+                if path == '/accounts/login' and method == 'POST':
+                    return self.send(200, {'access_token': 'standin-token', 'token_type': 'bearer', 'expires_in': 3600})
+                if ENVIRONMENTS_PATH.match(path) and method == 'GET':
+                    return self.send(200, {'data': [{'id': envId, 'name': envId} for envId in standIn.environments], 'total': len(standIn.environments)})
+
+                match = BROKER_PATH.match(path)
+                if match:
+                    return self.broker(match.group(1), method, match.group(2), payload)
+
+                match = STATS_PATH.match(path)
+                if match and method == 'GET':
+                    return self.stats(standIn.store(match.group(1, 2, 3)), match.group(4), match.group(5))
+
+                match = ADMIN_PATH.match(path)
+                if match is None:
+                    return self.send(404, {})
+                store = standIn.store(match.group(1, 2, 3))
+                return self.admin(store, method, match.group(4), payload)
+
+            def stats(self, store, kind, name):
+                if name not in store[kind]:
+                    return self.send(404, {})
+                now = time.time()
+                with standIn.lock:
+                    counters = dict(store['counters'].get(name, {}))
+                    messages = list(store['messages'].get(name, {}).values())
+                date = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(now))
+                if kind == 'queues':
+                    counters['visible'] = sum(1 for message in messages if message['lockedUntil'] <= now)
+                    counters['inFlight'] = len(messages) - counters['visible']
+                    names = {'messagesVisible': 'visible', 'messagesInFlight': 'inFlight', 'messagesSent': 'sent', 'messagesReceived': 'received', 'messagesAcked': 'acked'}
+                else:
+                    names = {'messagesPublished': 'published', 'messagesDelivered': 'delivered'}
+                return self.send(200, dict({stat: [{'date': date, 'value': counters.get(counter, 0)}] for stat, counter in names.items()}, destination=name))
+
+            def broker(self, region, method, path, payload):
+                if path == '/authorize' and method == 'POST':
+                    return self.send(200, {'access_token': 'standin-broker-token', 'token_type': 'bearer'})
+
+                match = MESSAGES_PATH.match(path)
+                if match is None:
+                    return self.send(404, {})
+                orgId, envId, destination, messageId, lockId = match.groups()
+                store = standIn.store((orgId, envId, region))
+
+                if messageId is not None:
+                    # Lock update, remainingTtl 0 releases the message #
+                    with standIn.lock:
+                        message = store['messages'].get(destination, {}).get(messageId)
+                        if method != 'PUT' or message is None or message['lockId'] != lockId:
+                            return self.send(404, {})
+                        message['lockedUntil'] = time.time() + payload.get('remainingTtl', 0) / 1000
+                    return self.send(200, {})
+
+                if method == 'GET':
+                    queue = store['queues'].get(destination)
+                    if queue is None:
+                        return self.send(404, {})
+                    lockTtl = float(self.query.get('lockTtl') or queue.get('defaultLockTtl') or 120000) / 1000
+                    batch = []
+                    with standIn.lock:
+                        now = time.time()
+                        for message in store['messages'].get(destination, {}).values():
+                            if message['lockedUntil'] <= now:
+                                message.update(lockId=uuid.uuid4().hex, lockedUntil=now + lockTtl, deliveryCount=message['deliveryCount'] + 1)
+                                batch.append({'properties': message['properties'], 'body': message['body'], 'headers': dict(message['headers'],
+                                    lockId=message['lockId'], deliveryCount=message['deliveryCount'])})
+                                if len(batch) >= int(self.query.get('batchSize') or 1):
+                                    break
+                        standIn.count(store, destination, 'received', len(batch))
+                    return self.send(200, batch)
+
+                if method == 'DELETE':
+                    # Acknowledgement of locked messages #
+                    statuses = []
+                    with standIn.lock:
+                        messages = store['messages'].get(destination, {})
+                        for lock in payload:
+                            message = messages.get(lock['messageId'])
+                            if message is not None and message['lockId'] == lock['lockId']:
+                                del messages[lock['messageId']]
+                                standIn.count(store, destination, 'acked', 1)
+                                statuses.append({'messageId': lock['messageId'], 'status': 'successful'})
+                            else:
+                                statuses.append({'messageId': lock['messageId'], 'status': 'failed', 'statusMessage': 'Unknown message or lock'})
+                    return self.send(200, statuses)
+
+                if method == 'PUT':
+                    # Published to an exchange, the messages are copied to every bound queue #
+                    if destination in store['queues']:
+                        queueIds = [destination]
+                    elif destination in store['exchanges']:
+                        queueIds = sorted(store['bindings'].get(destination, ()))
+                    else:
+                        return self.send(404, {})
+                    with standIn.lock:
+                        if destination in store['exchanges']:
+                            standIn.count(store, destination, 'published', len(payload))
+                            standIn.count(store, destination, 'delivered', len(payload) * len(queueIds))
+                        for queueId in queueIds:
+                            standIn.count(store, queueId, 'sent', len(payload))
+                        for message in payload:
+                            for queueId in queueIds:
+                                store['messages'].setdefault(queueId, OrderedDict())[message['messageId']] = {'properties': message.get('properties', {}),
+                                    'headers': {'messageId': message['messageId'], 'created': time.time()}, 'body': message['body'],
+                                    'lockId': None, 'lockedUntil': 0, 'deliveryCount': 0}
+                    return self.send(201, [{'destination': destination, 'messageId': message['messageId'], 'status': 'successful'} for message in payload])
+
+                return self.send(404, {})
+
+            def admin(self, store, method, path, payload):
+                if path == '/destinations' and method == 'GET':
+                    etag = '"' + str(store['version']) + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        return self.send(304)
+                    return self.send(200, list(store['queues'].values()) + list(store['exchanges'].values()), {'ETag': etag})
+
+                match = DESTINATION_PATH.match(path)
+                if match:
+                    kind, name, messages = match.groups()
+                    destinations = store[kind]
+                    if messages:
+                        if method != 'DELETE' or name not in destinations:
+                            return self.send(404, {})
+                        with standIn.lock:
+                            store['messages'].pop(name, None)
+                        return self.send(200, {})
+                    if method == 'GET':
+                        return self.send(200, destinations[name]) if name in destinations else self.send(404, {})
+                    if method in ('PUT', 'PATCH'):
+                        if method == 'PATCH' and name not in destinations:
+                            return self.send(404, {})
+                        destination = destinations.get(name, {}) if method == 'PATCH' else {}
+                        destination.update(payload)
+                        destination.update({'type': 'queue', 'queueId': name} if kind == 'queues' else {'type': 'exchange', 'exchangeId': name})
+                        destinations[name] = destination
+                        store['version'] += 1
+                        return self.send(201 if method == 'PUT' else 200, destination)
+                    if method == 'DELETE':
+                        if destinations.pop(name, None) is None:
+                            return self.send(404, {})
+                        store['bindings'].pop(name, None)
+                        store['version'] += 1
+                        return self.send(204)
+
+                match = BINDING_PATH.match(path)
+                if match:
+                    exchangeId, queueId = match.groups()
+                    if exchangeId not in store['exchanges']:
+                        return self.send(404, {})
+                    bindings = store['bindings'].setdefault(exchangeId, set())
+                    if queueId is None and method == 'GET':
+                        items = [{'exchangeId': exchangeId, 'queueId': item} for item in sorted(bindings)]
+                        etag = '"' + hashlib.sha1(json.dumps(items).encode()).hexdigest() + '"'
+                        if self.headers.get('If-None-Match') == etag:
+                            return self.send(304)
+                        return self.send(200, items, {'ETag': etag})
+                    if queueId is not None and queueId not in store['queues']:
+                        return self.send(404, {})
+                    if queueId is not None and method == 'PUT':
+                        bindings.add(queueId)
+                        return self.send(201, {})
+                    if queueId is not None and method == 'DELETE':
+                        bindings.discard(queueId)
+                        return self.send(204)
+
+                return self.send(404, {})
+
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+            def do_PUT(self):
+                self.dispatch('PUT')
+
+            def do_PATCH(self):
+                self.dispatch('PATCH')
+
+            def do_DELETE(self):
+                self.dispatch('DELETE')
+
+        return Handler
+
+
+@click.command()
+@click.option('--port', 'port', help='Port to listen on, 0 picks a free one', default=8081, type=int)
+@click.option('--destinations', 'destinations', help='Number of destinations of every region and environment', default=100, type=click.IntRange(min=0))
+@click.option('--latency', 'latency', help='Seconds added to every request', default=0.0, type=float)
+@click.option('--jitter', 'jitter', help='Random +/- seconds added to the latency', default=0.0, type=float)
+@click.option('--throttle-rate', 'throttleRate', help='Fraction of the requests answered with 429', default=0.0, type=click.FloatRange(0, 1))
+@click.option('--retry-after', 'retryAfter', help='Retry-After seconds of the 429 responses', default=1, type=float)
+@click.option('--environment', 'environments', help='Environment ids listed by the accounts API', default=['env'], multiple=True)
+def main(port, destinations, latency, jitter, throttleRate, retryAfter, environments):
+    """This command runs the stand-in server until interrupted"""
+
+    standIn = StandInServer(port, destinations, latency, jitter, throttleRate, retryAfter, environments)
+    print("Stand-in listening on " + standIn.url + ", use MQ_ANYPOINT_URL=" + standIn.url)
+    try:
+        standIn.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
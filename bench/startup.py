@@ -0,0 +1,56 @@
+import click
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+#### Times the mq startup: the module import, mq --help and a command help, in fresh interpreters ####
+#### e.g. python bench/startup.py --runs 20 ####
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCENARIOS = [
+    ('import mq', ['-c', 'import mq']),
+    ('mq --help', ['-c', 'import mq; mq.cli()', '--help']),
+    ('mq find-queue --help', ['-c', 'import mq; mq.cli()', 'find-queue', '--help']),
+]
+
+
+def importTimes(top):
+    """This function returns the <top> slowest imports of mq, as reported by python -X importtime (cumulative microseconds, module)"""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import mq'], cwd=ROOT, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times.append((int(parts[1].strip()), parts[2].rstrip()))
+
+    return sorted(times, reverse=True)[:top]
+
+
+@click.command()
+@click.option('--runs', 'runs', help='Fresh interpreters started per scenario', default=10, type=click.IntRange(min=1))
+@click.option('--top', 'top', help='Slowest imports listed', default=15, type=click.IntRange(min=0))
+def main(runs, top):
+    """This command reports the median and best wall time of every startup scenario, and the slowest imports of mq"""
+
+    print('%-24s %10s %10s' % ('scenario', 'median ms', 'best ms'))
+    for name, args in SCENARIOS:
+        durations = []
+        for run in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+            durations.append((time.perf_counter() - start) * 1000)
+        print('%-24s %10.1f %10.1f' % (name, statistics.median(durations), min(durations)))
+
+    if top:
+        print('')
+        print('%-12s %s' % ('cumulative', 'import (python -X importtime)'))
+        for micros, module in importTimes(top):
+            print('%9.1fms %s' % (micros / 1000, module))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,690 +1,1678 @@
 import click
 import time
 import os
-import requests
+import sys
 import json
-import os
-from requests.exceptions import HTTPError
-import memcache
+import hashlib
+import codecs
+import re
+import fnmatch
+import gzip
+import threading
+import random
+import csv
+import uuid
+from urllib.parse import urlsplit, urlencode
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+#### requests, memcache, httpx and asyncio are imported on first use, so mq --help and commands that answer from a local cache start fast ####
+#### requests and HTTPError are set by loadRequests ####
+class NotLoadedError(Exception):
+    """Stands for HTTPError in except clauses until requests is imported, nothing raises it"""
+
+requests = None
+HTTPAdapter = None
+HTTPError = NotLoadedError
+asyncio = None
+httpx = None
+
+
+ANYPOINT_URL = os.environ.get('MQ_ANYPOINT_URL', 'https://anypoint.mulesoft.com')   # overridden to point mq at bench/standin.py
+BROKER_URL = os.environ.get('MQ_BROKER_URL', 'https://mq-{region}.anypoint.mulesoft.com')   # {region} is replaced, overridden to point mq at bench/standin.py
+REGIONS = ["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"]
+HTTP_TIMEOUT = (10, 60)   # (connect, read) seconds
+HTTP_POOL_SIZE = 32
+TOKEN_DEFAULT_TTL = 900   # seconds, used when the login response has no expires_in
+TOKEN_EXPIRY_MARGIN = 60
+TOKEN_CACHE_SIZE = 64
+TOKEN_LOCK_TIMEOUT = 10   # seconds a login waits for another invocation refreshing the same token
+TOKEN_LOCK_POLL = 0.05
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF = 0.5   # seconds, doubled on every attempt
+RETRY_MAX_DELAY = 30
+BUNDLE_FORMAT = 'mq-bundle'
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = '.ndjson.gz'
+INDEX_DEFAULT_TTL = 30   # seconds the local destinations index answers lookups without asking the admin API
+STREAM_CHUNK_SIZE = 64 * 1024   # bytes read at a time from streamed listings
+PROGRESS_INTERVAL = 1   # seconds between import progress lines
+BROKER_BATCH_SIZE = 10   # messages per broker API batch request, the API maximum
+STATS_DEFAULT_TTL = 60   # seconds a stats snapshot answers repeated stats commands without asking the stats API
+STATS_FIELDS = ['type', 'name', 'depth', 'inFlight', 'sent', 'received', 'acked', 'published', 'delivered']
+BACKEND_OPTION = click.Choice(['threads', 'async'])
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # seconds, upper bounds of the --metrics latency histograms
+ENDPOINT_PLACEHOLDERS = {'organizations': '{orgId}', 'environments': '{envId}', 'regions': '{region}', 'queues': '{queueId}', 'exchanges': '{exchangeId}',
+    'destinations': '{destinationId}', 'messages': '{messageId}', 'locks': '{lockId}'}
 
 
 ###### COMMANDS #####
 
-@click.group()
-def cli():
+class LazyGroup(click.Group):
+    """Click group whose subcommands are only built when they run or show their help. Commands are registered with command()
+    like in a click.Group, using option() instead of click.option, and listed in mq --help from their docstring"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazyCommands = {}
+
+    def command(self, name=None, **attrs):
+        def register(fn):
+            self.lazyCommands[name or fn.__name__.lower().replace('_', '-')] = (fn, attrs)
+            return fn
+        return register
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazyCommands))
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.lazyCommands:
+            fn, attrs = self.lazyCommands[name]
+            for args, kwargs in fn.__dict__.get('lazyOptions', []):
+                fn = click.option(*args, **kwargs)(fn)
+            self.add_command(click.command(name, **attrs)(fn))
+        return super().get_command(ctx, name)
+
+    def format_commands(self, ctx, formatter):
+        names = self.list_commands(ctx)
+        if names:
+            limit = formatter.width - 6 - max(len(name) for name in names)
+            with formatter.section('Commands'):
+                formatter.write_dl([(name, (self.commands.get(name) or click.Command(name, help=self.lazyCommands[name][0].__doc__)).get_short_help_str(limit))
+                    for name in names])
+
+
+def option(*args, **kwargs):
+    """This decorator works like click.option, but the option is only built with its command, see LazyGroup"""
+
+    def record(fn):
+        fn.__dict__.setdefault('lazyOptions', []).append((args, kwargs))
+        return fn
+    return record
+
+
+def targetOptions(multiple=False, admin=True, broker=False):
+    """This decorator adds the credentials, region, organization and environment options shared by every command.
+    With multiple, --region and --environment-id take several values, see resolveTargets_util.
+    admin adds the --username and --password of the admin API, broker the --client-id and --client-secret of an MQ client app, see brokerLogin"""
+
+    if multiple:
+        region = option('--region','-r', 'regions', help='Anypoint MQ region. Repeat it to query several regions, or use all', envvar='MQ_REGION', multiple=True, type=click.Choice(REGIONS + ['all'], case_sensitive=True))
+        environment = option('--environment-id', 'envIds', help='Anypoint environment id. Comma-separated value, or all', envvar='MQ_ENV_ID', multiple=True)
+    else:
+        region = option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(REGIONS, case_sensitive=True))
+        environment = option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
+
+    credentials = []
+    if admin:
+        credentials += [
+            option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME'),
+            option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)]
+    if broker:
+        credentials += [
+            option('--client-id', 'clientId', help='Anypoint MQ client app id', envvar='MQ_CLIENT_ID'),
+            option('--client-secret', 'clientSecret', help='Anypoint MQ client app secret', envvar='MQ_CLIENT_SECRET', hide_input=True)]
+
+    def decorator(fn):
+        for decorate in reversed(credentials + [
+            region,
+            option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID'),
+            environment]):
+            fn = decorate(fn)
+        return fn
+    return decorator
+
+
+
+def backendOption():
+    """This decorator adds the --backend option of the bulk commands, see bulkExecutor_util"""
+
+    return option('--backend', 'backend', help='threads: one worker thread per concurrent request. async: one event loop, --concurrency caps the requests in flight (requires httpx)',
+        envvar='MQ_BACKEND', required=False, default='threads', type=BACKEND_OPTION)
+
+
+def concurrencyOption(help):
+    """This decorator adds the --concurrency option, help telling what runs in parallel"""
+
+    return option('--concurrency', 'concurrency', help=help, envvar='MQ_CONCURRENCY', required=False, default=1, type=click.IntRange(min=1))
+
+
+def matchOptions(kind):
+    """This decorator adds the --match, --regex and --dry-run options of the commands selecting the queues or exchanges (kind) by name pattern,
+    see bulkChanges_util"""
+
+    def decorator(fn):
+        for decorate in reversed([
+            option('--match', 'patterns', help='Glob pattern of the ' + kind + ' to select, e.g. pr-1234-*. Repeatable', required=False, multiple=True),
+            option('--regex', 'regex', help='The --match patterns are regular expressions', is_flag=True),
+            option('--dry-run', 'dryRun', help='Print the changes --match selects, without running them', is_flag=True)]):
+            fn = decorate(fn)
+        return fn
+    return decorator
+
+
+def cacheOptions(stats=False):
+    """This decorator adds the --no-cache and --refresh options of the commands answering from the local destinations index.
+    With stats, they apply to the stats snapshot as well"""
+
+    if stats:
+        noCache = option('--no-cache', 'noCache', help='Ask the admin and stats APIs instead of the local destinations index and stats snapshot', is_flag=True)
+        refresh = option('--refresh', 'refresh', help='Refresh the local destinations index and stats snapshot before answering', is_flag=True)
+    else:
+        noCache = option('--no-cache', 'noCache', help='Ask the admin API instead of the local destinations index', is_flag=True)
+        refresh = option('--refresh', 'refresh', help='Refresh the local destinations index before answering', is_flag=True)
+
+    def decorator(fn):
+        return noCache(refresh(fn))
+    return decorator
+
+@click.group(cls=LazyGroup)
+@click.option('--metrics', 'metricsFormat', help='Write request counts, bytes and latency histograms per endpoint, token cache hits and wall time when the command ends', envvar='MQ_METRICS', required=False, type=click.Choice(['json', 'prom']))
+@click.option('--metrics-file', 'metricsFile', help='File the --metrics summary is written to, stderr by default', envvar='MQ_METRICS_FILE', required=False, type=click.Path(dir_okay=False))
+@click.option('--trace', 'traceFile', help='Write one NDJSON event per HTTP request (retries included) to this file', envvar='MQ_TRACE', required=False, type=click.File('w'))
+@click.pass_context
+def cli(ctx, metricsFormat, metricsFile, traceFile):
     """
     Simple CLI for managing queues, exchange, and fifo queues in Anypoint MQ
     """
-    pass
+    metrics = enableMetrics(metricsFormat is not None or traceFile is not None, traceFile)
+    if metricsFormat is not None:
+        ctx.call_on_close(lambda: writeMetrics_util(metrics, metricsFormat, metricsFile))
 
 
 @cli.command()
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-def search(username, password, region, orgId, envId):
-    """This search and return queues, exchanges, fifo queues corresponding to the given region, org id and environment id"""
+@targetOptions(multiple=True)
+@cacheOptions()
+def search(username, password, regions, orgId, envIds, noCache, refresh):
+    """This search and return queues, exchanges, fifo queues corresponding to the given regions, org id and environment ids.
+    Several regions or environments are searched concurrently and print one JSON line per destination, tagged with its region and environment"""
 
     #### Anypoint login ####
     token = login(username, password)
+    targets = resolveTargets_util(token, orgId, regions, envIds)
 
-    #### Request destinations to AMQ Rest API ####
-    destinations_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations'
-    payload = {}
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
-
-    try:
-        destinations = requests.request(
-        "GET", destinations_request_url, headers=headers, data=payload)
-        destinations.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
-
+    if len(targets) == 1:
+        client = MQClient(token, targets[0][0], orgId, targets[0][1])
+        printJsonArray_util(search_util(client, noCache, refresh))
+    else:
+        searchTargets_util(token, orgId, targets, noCache, refresh)
 
-    #### Build payload to return ####
-    queues = []
-    for value in destinations.json():
-        queues.append(
-            {   
-                "name": value.get('queueId') if value.get('queueId') != None else value.get('exchangeId'),
-                "fifo": value.get('fifo') if value.get('fifo') != None else False,
-                "exchange": True if value.get('type') == 'exchange' else False
-            }
-        )
-    
-    print(json.dumps(queues))
 
 @cli.command(name="find-queue")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Queue name', required=True)
-def findQueue(username, password, region, orgId, envId, name):
-    """This command will try to find a queue in a given region, org id and environment id"""
+@targetOptions()
+@option('--name', 'names', help='Queue name. Repeat the option or use a comma-separated value to look for several names', multiple=True)
+@option('--names-file', 'namesFile', help='File with one queue name per line', required=False, type=click.File('r'))
+@cacheOptions()
+def findQueue(username, password, region, orgId, envId, names, namesFile, noCache, refresh):
+    """This command will try to find a queue, or several ones, in a given region, org id and environment id"""
+
+    single = namesFile is None and not any(',' in value for value in names)
+    names = parseNames_util(names, namesFile)
+    if not names:
+        raise click.UsageError('--name or --names-file is required')
 
     #### Anypoint login ####
-    token = login(username, password)
-
-    #### Request destinations to AMQ Rest API ####
-    destinations_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/queues/' + name
-    payload = {}
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    try:
-        destinations = requests.request(
-        "GET", destinations_request_url, headers=headers, data=payload)
-        destinations.raise_for_status()
+    #### A names file, a comma-separated value or several names are checked against a single destinations listing and returned as a name -> exists map ####
+    if single and len(names) == 1:
+        print(json.dumps(findQueue_util(client, names[0], noCache, refresh)))
+    else:
+        print(json.dumps(findDestinations_util(client, 'queue', names, noCache, refresh)))
 
-        print(json.dumps({   
-            "exists": True,
-            "message": name + " already exists"
-        }))
-    except HTTPError as http_err:
-        if http_err.response.status_code == 404:
-           print(json.dumps({   
-                "exists": False,
-                "message": name + " does not exist"
-            }))
-        else:
-            raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
 
 @cli.command(name="find-exchange")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Queue name', required=True)
-def findExchange(username, password, region, orgId, envId, name):
-    """This command will try to find an exchange in a given region, org id and environment id"""
+@targetOptions()
+@option('--name', 'names', help='Exchange name. Repeat the option or use a comma-separated value to look for several names', multiple=True)
+@option('--names-file', 'namesFile', help='File with one exchange name per line', required=False, type=click.File('r'))
+@cacheOptions()
+def findExchange(username, password, region, orgId, envId, names, namesFile, noCache, refresh):
+    """This command will try to find an exchange, or several ones, in a given region, org id and environment id"""
+
+    single = namesFile is None and not any(',' in value for value in names)
+    names = parseNames_util(names, namesFile)
+    if not names:
+        raise click.UsageError('--name or --names-file is required')
 
     #### Anypoint login ####
-    token = login(username, password)
-
-    #### Request destinations to AMQ Rest API ####
-    destinations_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/exchanges/' + name
-    payload = {}
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
-
-    try:
-        destinations = requests.request(
-        "GET", destinations_request_url, headers=headers, data=payload)
-        destinations.raise_for_status()
+    client = MQClient(login(username, password), region, orgId, envId)
 
-        print(json.dumps({   
-            "exists": True,
-            "message": name + " already exists"
-        }))
-    except HTTPError as http_err:
-        if http_err.response.status_code == 404:
-           print(json.dumps({   
-                "exists": False,
-                "message": name + " does not exist"
-            }))
-        else:
-            raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+    #### A names file, a comma-separated value or several names are checked against a single destinations listing and returned as a name -> exists map ####
+    if single and len(names) == 1:
+        print(json.dumps(findExchange_util(client, names[0], noCache, refresh)))
+    else:
+        print(json.dumps(findDestinations_util(client, 'exchange', names, noCache, refresh)))
 
-    
 
 @cli.command(name="create-queue")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Queue name', required=True)
-@click.option('--fifo', 'fifo', help='Specifies if it is a FIFO queue', required=False, default=False, type=bool)
-#@click.option('--exchange', 'exchange', help='Specifies if it is an Exchange queue', required=False, default=False)
-@click.option('--ttl', 'ttl', help='Specifies TTL configuration in ms', required=False, default=120000)
-@click.option('--lock-ttl', 'lockTtl', help='Specifies Lock TTL configuration in ms', required=False, default=10000)
-@click.option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
-@click.option('--dead-letter-queue', 'deadLetterQueue', help='Specifies the name of the DLQ', required=False)
-@click.option('--max-attempts', 'maxAttempts', help='Specifies the max deliveries attempts before DLQ redirection', required=False)
-@click.option('--delivery-delay', 'deliveryDelay', help='Specifies the delivery delay time in ms', required=False)
+@targetOptions()
+@option('--name', 'name', help='Queue name', required=True)
+@option('--fifo', 'fifo', help='Specifies if it is a FIFO queue', required=False, default=False, type=bool)
+#@option('--exchange', 'exchange', help='Specifies if it is an Exchange queue', required=False, default=False)
+@option('--ttl', 'ttl', help='Specifies TTL configuration in ms', required=False, default=120000)
+@option('--lock-ttl', 'lockTtl', help='Specifies Lock TTL configuration in ms', required=False, default=10000)
+@option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
+@option('--dead-letter-queue', 'deadLetterQueue', help='Specifies the name of the DLQ', required=False)
+@option('--max-attempts', 'maxAttempts', help='Specifies the max deliveries attempts before DLQ redirection', required=False)
+@option('--delivery-delay', 'deliveryDelay', help='Specifies the delivery delay time in ms', required=False)
 def createQueue(username, password, region, orgId, envId, name, fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay):
     """This command creates a queue (standard or FIFO) in the given region, org id and environment id """
     #### Anypoint login ####
-    token = login(username, password)
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    createQueue_util(token, region, orgId, envId, name, fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay)    
+    print(json.dumps(createQueue_util(client, name, fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay)))
 
     
 @cli.command(name="update-queue")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Queue name', required=True)
-@click.option('--fifo', 'fifo', help='Specifies if it is a FIFO queue', required=False, default=False, type=bool)
-#@click.option('--exchange', 'exchange', help='Specifies if it is an Exchange queue', required=False, default=False)
-@click.option('--ttl', 'ttl', help='Specifies TTL configuration in ms', required=False, default=120000)
-@click.option('--lock-ttl', 'lockTtl', help='Specifies Lock TTL configuration in ms', required=False, default=10000)
-@click.option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
-@click.option('--dead-letter-queue', 'deadLetterQueue', help='Specifies the name of the DLQ', required=False)
-@click.option('--max-attempts', 'maxAttempts', help='Specifies the max deliveries attempts before DLQ redirection', required=False)
-@click.option('--delivery-delay', 'deliveryDelay', help='Specifies the delivery delay time in ms', required=False)
+@targetOptions()
+@option('--name', 'name', help='Queue name', required=True)
+@option('--fifo', 'fifo', help='Specifies if it is a FIFO queue', required=False, default=False, type=bool)
+#@option('--exchange', 'exchange', help='Specifies if it is an Exchange queue', required=False, default=False)
+@option('--ttl', 'ttl', help='Specifies TTL configuration in ms', required=False, default=120000)
+@option('--lock-ttl', 'lockTtl', help='Specifies Lock TTL configuration in ms', required=False, default=10000)
+@option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
+@option('--dead-letter-queue', 'deadLetterQueue', help='Specifies the name of the DLQ', required=False)
+@option('--max-attempts', 'maxAttempts', help='Specifies the max deliveries attempts before DLQ redirection', required=False)
+@option('--delivery-delay', 'deliveryDelay', help='Specifies the delivery delay time in ms', required=False)
 def updateQueue(username, password, region, orgId, envId, name, fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay):
     """This command creates a queue (standard or FIFO) in the given region, org id and environment id """
 
     #### Anypoint login ####
-    token = login(username, password)
-
-    #### Request destinations PUT to AMQ Rest API ####
-
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/queues/' + name
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    payload = {
-      "defaultTtl" : ttl,
-      "defaultLockTtl" : lockTtl,
-      "encrypted" : encrypted,
-      "fifo" : fifo,
-      "deadLetterQueueId": deadLetterQueue,
-      "maxDeliveries": maxAttempts,
-      "defaultDeliveryDelay": deliveryDelay
-    }
-
-
-    try:
-        response = requests.request(
-        "PATCH", mq_request_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
-
-
-    #### Build payload to return ####
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully updated"
-    }))
+    print(json.dumps(updateQueue_util(client, name, fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay)))
 
 
 @cli.command(name="create-exchange")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Exchange name', required=True)
-@click.option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
+@targetOptions()
+@option('--name', 'name', help='Exchange name', required=True)
+@option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
 def createExchange(username, password, region, orgId, envId, name, encrypted):
     """This command creates an exchange in the given region, org id and environment id  """
     #### Anypoint login ####
-    token = login(username, password)
+    client = MQClient(login(username, password), region, orgId, envId)
+
+    print(json.dumps(createExchange_util(client, name, encrypted)))
 
-    createExchange_util(token, region, orgId, envId, name, encrypted)
- 
 
 @cli.command(name="update-exchange")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Exchange name', required=True)
-@click.option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
+@targetOptions()
+@option('--name', 'name', help='Exchange name', required=True)
+@option('--encrypted', 'encrypted', help='Specifies if queue is encrypted', required=False, default=False)
 def updateExchange(username, password, region, orgId, envId, name, encrypted):
     """This command creates an exchange in the given region, org id and environment id  """
 
     #### Anypoint login ####
-    token = login(username, password)
-
-    #### Request destinations PUT to AMQ Rest API ####
-
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/exchanges/' + name
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
-
-    payload = {
-      "encrypted" : encrypted
-    }
-
-    try:
-        response = requests.request(
-        "PATCH", mq_request_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+    client = MQClient(login(username, password), region, orgId, envId)
 
+    print(json.dumps(updateExchange_util(client, name, encrypted)))
 
-    #### Build payload to return ####
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully updated"
-    }))
 
 @cli.command(name="bind-queue")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--exchange-name', 'name', help='Exchange name', required=True)
-@click.option('--queue-name', 'queueName', help='Queue to bind to exchange. Comma-separated value', required=True)
-def bindQueues(username, password, region, orgId, envId, name, queueName):
-    """This command creates an exchange in the given region, org id and environment id  """
+@targetOptions()
+@option('--exchange-name', 'names', help='Exchange name. Comma-separated value', required=True, multiple=True)
+@option('--queue-name', 'queueNames', help='Queue to bind to exchange. Comma-separated value', required=True, multiple=True)
+@concurrencyOption('Number of bindings created in parallel')
+@backendOption()
+def bindQueues(username, password, region, orgId, envId, names, queueNames, concurrency, backend):
+    """This command binds queues to exchanges in the given region, org id and environment id. Every queue is bound to every exchange"""
     #### Anypoint login ####
-    token = login(username, password)
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    bindQueues_util(token, region, orgId, envId, name, queueName)
+    fanOutBindings_util(client, bindQueues_util, parseNames_util(names), parseNames_util(queueNames), concurrency, backend)
 
 
 @cli.command(name="unbind-queue")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--exchange-name', 'name', help='Exchange name', required=True)
-@click.option('--queue-name', 'queueName', help='Queue to unbind from exchange. Comma-separated value', required=True)
-def unbindQueues(username, password, region, orgId, envId, name, queueName):
-    """This command creates an exchange in the given region, org id and environment id  """
+@targetOptions()
+@option('--exchange-name', 'names', help='Exchange name. Comma-separated value', required=True, multiple=True)
+@option('--queue-name', 'queueNames', help='Queue to unbind from exchange. Comma-separated value', required=True, multiple=True)
+@concurrencyOption('Number of bindings deleted in parallel')
+@backendOption()
+def unbindQueues(username, password, region, orgId, envId, names, queueNames, concurrency, backend):
+    """This command unbinds queues from exchanges in the given region, org id and environment id"""
 
     #### Anypoint login ####
-    token = login(username, password)
-
-    #### Request destinations PUT to AMQ Rest API ####
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/bindings/exchanges/' + name + '/queues/' + queueName
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    fanOutBindings_util(client, unbindQueues_util, parseNames_util(names), parseNames_util(queueNames), concurrency, backend)
 
 
-    try:
-        response = requests.request(
-        "DELETE", mq_request_url, headers=headers)
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+@cli.command(name="delete-queue")
+@targetOptions()
+@option('--name', 'name', help='Queue name', required=False)
+@matchOptions('queues')
+@concurrencyOption('Number of requests run in parallel with --match')
+@backendOption()
+def deleteQueue(username, password, region, orgId, envId, name, patterns, regex, dryRun, concurrency, backend):
+    """This command purges a queue in the given region, org id and environment id.
+    With --match every matching queue, from a single destinations listing, is deleted concurrently, dead letter queues after the queues using them"""
+
+    if (name is None) == (not patterns):
+        raise click.UsageError('Exactly one of --name or --match is required')
 
+    #### Anypoint login ####
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    #### Build payload to return ####
-    print(json.dumps({   
-        "success": True,
-        "message": queueName + " was successfully unbinded from " + name
-    }))
+    if name is not None:
+        print(json.dumps(deleteQueue_util(client, name)))
+    else:
+        bulkChanges_util(client, 'delete-queue', patterns, regex, dryRun, concurrency, backend)
 
 
-@cli.command(name="delete-queue")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Queue name', required=True)
-def deleteQueue(username, password, region, orgId, envId, name):
-    """This command purges a queue in the given region, org id and environment id"""
+@cli.command(name="delete-exchange")
+@targetOptions()
+@option('--name', 'name', help='Exchange name', required=False)
+@matchOptions('exchanges')
+@concurrencyOption('Number of requests run in parallel with --match')
+@backendOption()
+def deleteExchange(username, password, region, orgId, envId, name, patterns, regex, dryRun, concurrency, backend):
+    """This command purges a queue in the given region, org id and environment id.
+    With --match every matching exchange, from a single destinations listing, is deleted concurrently, after unbinding them from their queues"""
+
+    if (name is None) == (not patterns):
+        raise click.UsageError('Exactly one of --name or --match is required')
 
     #### Anypoint login ####
-    token = login(username, password)
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    #### Request destinations PUT to AMQ Rest API ####
+    if name is not None:
+        print(json.dumps(deleteExchange_util(client, name)))
+    else:
+        bulkChanges_util(client, 'delete-exchange', patterns, regex, dryRun, concurrency, backend)
 
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/queues/' + name
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
 
+@cli.command()
+@targetOptions()
+@option('--name', 'name', help='Queue name', required=False)
+@matchOptions('queues')
+@concurrencyOption('Number of requests run in parallel with --match')
+@backendOption()
+def purge(username, password, region, orgId, envId, name, patterns, regex, dryRun, concurrency, backend):
+    """This command purges a queue in the given region, org id and environment id.
+    With --match every matching queue, from a single destinations listing, is purged concurrently"""
+
+    if (name is None) == (not patterns):
+        raise click.UsageError('Exactly one of --name or --match is required')
 
-    try:
-        response = requests.request("DELETE", mq_request_url, headers=headers)
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+    #### Anypoint login ####
+    client = MQClient(login(username, password), region, orgId, envId)
 
+    if name is not None:
+        print(json.dumps(purge_util(client, name)))
+    else:
+        bulkChanges_util(client, 'purge', patterns, regex, dryRun, concurrency, backend)
 
-    #### 3rd: Build payload to return ####
-    
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully purged"
-    }))
 
-@cli.command(name="delete-exchange")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Exchange name', required=True)
-def deleteExchange(username, password, region, orgId, envId, name):
-    """This command purges a queue in the given region, org id and environment id"""
+@cli.command()
+@targetOptions(multiple=True)
+@option('--conf-path', 'confPath', help='Path where conf files will be generated. With several regions or environments, one sub directory (or bundle) per region and environment', envvar='CONF_PATH',  required=False)
+@concurrencyOption('Number of exchanges whose bindings are exported in parallel')
+@option('--format', 'format', help='files: one json file per destination and bindings set. bundle: a single gzip compressed NDJSON file', required=False, default='files', type=click.Choice(['files', 'bundle']))
+@backendOption()
+def export(username, password, regions, orgId, envIds, confPath, concurrency, format, backend):
+    """This search and return queues, exchanges, fifo queues and bindings corresponding to the given regions, org id and environment ids and exports them to json files.
+    Several regions or environments are exported concurrently"""
+
+    start = time.time()
 
     #### Anypoint login ####
     token = login(username, password)
+    targets = resolveTargets_util(token, orgId, regions, envIds)
 
-    #### Request destinations DELETE to AMQ Rest API ####
+    timestamp = time.strftime("%Y-%m-%d_%H%M%S")
 
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/exchanges/' + name
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    if (confPath != '') and (confPath != None):
+        dir = confPath
+    else:
+        dir = timestamp
 
+    if len(targets) == 1:
+        dir, failures = exportTarget_util(MQClient(token, targets[0][0], orgId, targets[0][1]), dir, format, concurrency, backend)
+    else:
+        #### Every region and environment is exported to its own path, a slow one does not hold the others back ####
+        failures = []
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = {executor.submit(exportTarget_util, MQClient(token, region, orgId, envId), os.path.join(dir, region, envId) if format == 'files' else os.path.join(dir, region + '_' + envId),
+                format, concurrency, backend, '[' + region + '/' + envId + '] '): (region, envId) for region, envId in targets}
+            for future in as_completed(futures):
+                region, envId = futures[future]
+                try:
+                    failures.extend(future.result()[1])
+                except Exception as err:
+                    failures.append(region + '/' + envId)
+                    print('[' + region + '/' + envId + '] Export failed: ' + str(err))
+
+    print("Output path: " + os.path.abspath(dir))
+    print("Elapsed time: " + str(round(time.time() - start, 2)) + "s")
+
+    if failures:
+        raise Exception('Export failed for: ' + ', '.join(failures))
 
-    try:
-        response = requests.request("DELETE", mq_request_url, headers=headers)
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+    print("Export Done")
+
+
+@cli.command(name="import")
+@targetOptions()
+@option('--conf-path', 'confPath', help='Path from where to load the exported conf files, or the exported bundle file', envvar='CONF_PATH')
+@concurrencyOption('Number of destinations and bindings created in parallel within a wave')
+@backendOption()
+@option('--journal', 'journalPath', help='File where completed and failed items are journaled, under ~/.cache/mq/journals by default. An explicit file is overwritten without --resume', envvar='MQ_IMPORT_JOURNAL', required=False)
+@option('--resume', 'resume', help='Skip the items the journal records as done, only failed and pending items are imported', is_flag=True)
+def importConf(username, password, region, orgId, envId, confPath, concurrency, backend, journalPath, resume):
+    """This search and return queues, exchanges, fifo queues and bindings corresponding to the given region, org id and environment id and exports them to a json file"""
+
+    start = time.time()
+
+    #### Anypoint login ####
+    client = MQClient(login(username, password), region, orgId, envId)
+
+#### DLQs MUST EXIST BEFORE THE QUEUES THAT REFERENCE THEM AND QUEUES/EXCHANGES BEFORE THEIR BINDINGS,
+#### SO THE EXPORTED FILES ARE SPLIT IN WAVES WHERE EVERY ITEM ONLY DEPENDS ON PREVIOUS WAVES
+    nodes = loadImportGraph_util(confPath)
+    waves = importWaves_util(nodes)
+
+#### EVERY COMPLETED OR FAILED ITEM IS JOURNALED, SO A RE-RUN WITH --resume ONLY IMPORTS THE FAILED AND PENDING ONES
+    target = {"region": region, "organizationId": orgId, "environmentId": envId}
+    journal = ImportJournal(journalPath or importJournalPath(confPath, target), target, resume, overwrite=journalPath is not None)
+    print("Journal: " + journal.path)
+    progress = ImportProgress(len(nodes))
+
+    failed = set()
+    with journal, client.index.deferred(), bulkExecutor_util(client, backend, concurrency) as executor:
+        for number, wave in enumerate(waves, start=1):
+            pending = [key for key in wave if not journal.isDone(nodes[key])]
+            progress.skip(len(wave) - len(pending))
+            print("Importing wave " + str(number) + " (" + str(len(pending)) + " items" + (", " + str(len(wave) - len(pending)) + " already done" if len(pending) < len(wave) else "") + ")")
+            if backend == 'async':
+                results = executor.map(lambda aclient, key: importItemAsync_util(aclient, nodes[key], failed), pending)
+            else:
+                results = executor.map(lambda key: importItem_util(client, nodes[key], failed), pending)
+            for key, error in zip(pending, results):
+                journal.record(nodes[key], error)
+                progress.step()
+                if error is not None:
+                    failed.add(key)
+                    print("Import failed for " + nodes[key]['file'] + ": " + error)
+
+    print("Elapsed time: " + str(round(time.time() - start, 2)) + "s")
 
+    if failed:
+        raise Exception('Import failed for: ' + ', '.join(sorted(set(nodes[key]['file'] for key in failed))) +
+            '. Run it again with --resume to only import the failed and pending items')
 
-    #### 3rd: Build payload to return ####
+    print("Import Done")
     
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully purged"
-    }))
 
 @cli.command()
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--name', 'name', help='Queue name', required=True)
-def purge(username, password, region, orgId, envId, name):
-    """This command purges a queue in the given region, org id and environment id"""
+@targetOptions()
+@option('--conf-path', 'confPath', help='Path from where to load the exported conf files (desired state)', envvar='CONF_PATH', required=True)
+@option('--prune', 'prune', help='Also delete the queues and exchanges that are not in the conf files', is_flag=True)
+@option('--out', 'out', help='File where the plan is saved, to be run later with apply --plan', required=False, type=click.File('w'))
+@concurrencyOption('Number of exchange bindings fetched in parallel')
+@backendOption()
+def plan(username, password, region, orgId, envId, confPath, prune, out, concurrency, backend):
+    """This command compares the exported conf files with the live queues, exchanges and bindings of the given region, org id and environment id
+    and prints the minimal set of changes (create, patch, bind, unbind, delete) that apply would run"""
 
     #### Anypoint login ####
-    token = login(username, password)
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    #### Request destinations PUT to AMQ Rest API ####
+    changePlan = planChanges_util(client, confPath, prune, concurrency, backend)
+    if out is not None:
+        json.dump(changePlan, out)
 
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/queues/' + name + '/messages'
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    print(json.dumps(changePlan))
 
 
-    try:
-        response = requests.request("DELETE", mq_request_url, headers=headers)
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+@cli.command()
+@targetOptions()
+@option('--conf-path', 'confPath', help='Path from where to load the exported conf files (desired state)', envvar='CONF_PATH', required=False)
+@option('--plan', 'planFile', help='Plan saved with plan --out, instead of computing it from --conf-path', required=False, type=click.File('r'))
+@option('--prune', 'prune', help='Also delete the queues and exchanges that are not in the conf files', is_flag=True)
+@concurrencyOption('Number of changes run in parallel within a wave')
+@backendOption()
+def apply(username, password, region, orgId, envId, confPath, planFile, prune, concurrency, backend):
+    """This command runs only the changes needed to make the given region, org id and environment id match the exported conf files"""
 
+    start = time.time()
 
-    #### 3rd: Build payload to return ####
-    
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully purged"
-    }))
+    if (planFile is None) == (not confPath):
+        raise click.UsageError('Exactly one of --conf-path or --plan is required')
+
+    #### Anypoint login ####
+    client = MQClient(login(username, password), region, orgId, envId)
+
+    if planFile is not None:
+        changePlan = json.load(planFile)
+        if changePlan['target'] != {"region": region, "organizationId": orgId, "environmentId": envId}:
+            raise Exception('The plan was computed for another target: ' + json.dumps(changePlan['target']))
+    else:
+        changePlan = planChanges_util(client, confPath, prune, concurrency, backend)
+
+    applyChanges_util(client, changePlan['changes'], concurrency, start, backend)
 
 
 @cli.command()
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--conf-path', 'confPath', help='Path where conf files will be generated', envvar='CONF_PATH',  required=False)
-
-def export(username, password, region, orgId, envId, confPath):
-    """This search and return queues, exchanges, fifo queues and bindings corresponding to the given region, org id and environment id and exports them to a json file"""
+@targetOptions()
+@option('--type', 'kind', help='Destinations whose stats are fetched', required=False, default='all', type=click.Choice(['all', 'queue', 'exchange']))
+@option('--window', 'window', help='Seconds of stats: depth and in flight are the latest values, the counters are totals over the window', required=False, default=300, type=click.IntRange(min=1))
+@option('--format', 'format', help='table: aligned columns. ndjson: one JSON line per destination. csv: with a header line', required=False, default='table', type=click.Choice(['table', 'ndjson', 'csv']))
+@option('--sort', 'sort', help='Field the destinations are sorted by, counters in descending order', required=False, default='name', type=click.Choice(STATS_FIELDS[1:]))
+@option('--top', 'top', help='Only print the first N destinations once sorted, e.g. --sort depth --top 20', required=False, type=click.IntRange(min=1))
+@concurrencyOption('Number of destinations whose stats are fetched in parallel')
+@cacheOptions(stats=True)
+def stats(username, password, region, orgId, envId, kind, window, format, sort, top, concurrency, noCache, refresh):
+    """This command fetches the depth, in flight and throughput stats of every queue and exchange of the given region, org id and environment id
+    from a single destinations listing, concurrently, and prints them sorted as a table, NDJSON or CSV. Snapshots are cached for MQ_STATS_TTL seconds"""
 
     #### Anypoint login ####
-    token = login(username, password)
+    client = MQClient(login(username, password), region, orgId, envId)
 
-    #### Request destinations to AMQ Rest API ####
-    destinations_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations'
-    payload = {}
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
-
-    try:
-        destinations = requests.request(
-        "GET", destinations_request_url, headers=headers, data=payload)
-        destinations.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+    rows = statsSnapshot_util(client, kind, window, concurrency, noCache, refresh)
+    failures = [row for row in rows if 'error' in row]
+    rows = sortStats_util(rows, sort)[:top]
 
+    printStats_util(rows, format)
 
+    if failures:
+        raise Exception('Stats failed for ' + str(len(failures)) + ' destinations: ' + ', '.join(row['name'] for row in failures))
 
-    
-    json_string = json.dumps(destinations.json())
 
-    timestamp = time.strftime("%Y-%m-%d_%H%M%S")
+@cli.command()
+@targetOptions()
+@option('--interval', 'interval', help='Seconds between polls after a change, doubled after every poll without changes', required=False, default=5, type=click.FloatRange(min=0, min_open=True))
+@option('--max-interval', 'maxInterval', help='Longest number of seconds between polls', required=False, default=60, type=click.FloatRange(min=0, min_open=True))
+@option('--bindings', 'bindings', help='Also watch the bindings, with one conditional request per exchange and poll', is_flag=True)
+@option('--initial', 'initial', help='Start with an added event per existing destination (and binding)', is_flag=True)
+@option('--duration', 'duration', help='Stop after this many seconds, runs until interrupted by default', required=False, type=click.FloatRange(min=0))
+@concurrencyOption('Number of exchange bindings fetched in parallel')
+def watch(username, password, region, orgId, envId, interval, maxInterval, bindings, initial, duration, concurrency):
+    """This command watches the queues and exchanges (and bindings) of the given region, org id and environment id and prints one NDJSON event per
+    added, removed or modified one. Polls are conditional, an unchanged listing is not downloaded again, and slow down while nothing changes"""
+
+    #### Anypoint login, the token is taken from the cache again before every poll so it is refreshed once expired ####
+    client = MQClient(login(username, password), region, orgId, envId)
+    watcher = DestinationsWatcher(client, bindings, concurrency)
 
-    if (confPath != '') and (confPath != None):
-        dir = confPath
-    else:
-        dir = timestamp
-    
-    print("path:" + dir)
+    try:
+        watch_util(watcher, lambda: login(username, password), interval, maxInterval, initial, duration)
+    except KeyboardInterrupt:
+        pass
 
-    if not os.path.exists(dir):
-        os.mkdir(dir)
 
-    #### Build payload to return ####
-    queues = []
-    for value in destinations.json():
-       if(value.get('type') == 'queue' ):
-            print("Queue extracted: " + value.get('queueId') )
-            if(str(value.get('deadLetterSources')) == 'None'):
-                with open(dir + '/queue_' + value.get('queueId') + '.json', 'w') as outfile:
-                    outfile.write(json.dumps(value))
-            else:
-                with open(dir + '/queue-dlq_' + value.get('queueId') + '.json', 'w') as outfile:
-                    outfile.write(json.dumps(value))              
-       else:
-            exchangeId = value.get('exchangeId')
-            print("Exchange with bindings extracted: " + exchangeId)
-            with open(dir + '/exchange_' + exchangeId + '.json', 'w') as outfile:
-                outfile.write(json.dumps(value))
-            
-            bindings_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-                orgId + '/environments/' + envId + '/regions/' + region + '/bindings/exchanges/' + exchangeId
-            payload = {}
-            headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-                    token}
+@cli.command()
+@targetOptions(admin=False, broker=True)
+@option('--destination', 'destination', help='Queue or exchange the messages are published to', required=True)
+@option('--file', 'file', help='NDJSON file with one message per line, like {"body": "...", "properties": {...}, "messageId": "..."}, stdin by default', required=False, default='-', type=click.File('r'))
+@option('--batch-size', 'batchSize', help='Messages per broker API request', required=False, default=BROKER_BATCH_SIZE, type=click.IntRange(min=1, max=BROKER_BATCH_SIZE))
+@concurrencyOption('Number of batch requests in flight')
+def publish(clientId, clientSecret, region, orgId, envId, destination, file, batchSize, concurrency):
+    """This command publishes messages, read as NDJSON lines, to a queue or exchange through the broker API, in batches with several requests in flight.
+    A line without a body field is published as is. One JSON line is printed per failed message, then the totals and messages per second"""
 
-            try:
-                bindings = requests.request(
-                "GET", bindings_request_url, headers=headers, data=payload)
-                bindings.raise_for_status()
-            except HTTPError as http_err:
-                raise Exception('HTTP error occurred: ' + str(http_err))
-            except Exception as err:
-                raise Exception('Other error occurred: ' + str(err))
+    #### Broker login, with the client app credentials ####
+    broker = BrokerClient(brokerLogin(region, clientId, clientSecret), region, orgId, envId)
 
-            json_string = json.dumps(bindings.json())   
+    publishLines_util(broker, destination, file, batchSize, concurrency)
 
-            with open(dir + '/bindings_' + exchangeId + '.json', 'w') as outfile:
-                outfile.write(json_string)
 
-    print("Output path: " + os.path.abspath(os.getcwd()) + '/' + dir)            
-    print("Export Done")
+@cli.command()
+@targetOptions(admin=False, broker=True)
+@option('--destination', 'destination', help='Queue (or dead letter queue) the messages are consumed from', required=True)
+@option('--out', 'out', help='NDJSON file the messages are written to, one per line, stdout by default', required=False, default='-', type=click.File('w'))
+@option('--prefetch', 'prefetch', help='Messages pulled and locked ahead of writing, in batches of --batch-size', required=False, default=BROKER_BATCH_SIZE, type=click.IntRange(min=1))
+@option('--batch-size', 'batchSize', help='Messages per pull request', required=False, default=BROKER_BATCH_SIZE, type=click.IntRange(min=1, max=BROKER_BATCH_SIZE))
+@option('--lock-ttl', 'lockTtl', help='Milliseconds a pulled message stays locked before being redelivered, the queue defaultLockTtl by default', required=False, type=click.IntRange(min=1))
+@option('--poll', 'poll', help='Milliseconds a pull waits for messages on an empty queue', required=False, default=0, type=click.IntRange(min=0))
+@option('--max-messages', 'maxMessages', help='Stop after this many messages', required=False, type=click.IntRange(min=1))
+@option('--timeout', 'timeout', help='Stop pulling after this many seconds', required=False, type=click.FloatRange(min=0))
+@option('--nack', 'nack', help='Release the messages once written instead of acknowledging them, so they stay in the queue', is_flag=True)
+@concurrencyOption('Number of ack (or nack) requests in flight')
+def consume(clientId, clientSecret, region, orgId, envId, destination, out, prefetch, batchSize, lockTtl, poll, maxMessages, timeout, nack, concurrency):
+    """This command drains a queue through the broker API to an NDJSON file, in the format read by publish, until the queue is empty, --max-messages or --timeout.
+    Every batch is written before being acknowledged (or released with --nack), acks run concurrently with the next pulls. The totals are printed to stderr"""
+
+    #### Broker login, with the client app credentials ####
+    broker = BrokerClient(brokerLogin(region, clientId, clientSecret), region, orgId, envId)
+
+    consumeMessages_util(broker, destination, out, prefetch, batchSize, lockTtl, poll, maxMessages, timeout, nack, concurrency)
 
 
-@cli.command(name="import")
-@click.option('--username', 'username', help='Anypoint username',  envvar='MQ_USERNAME')
-@click.option('--password', 'password', help='Anypoint password', envvar='MQ_PASSWORD', hide_input=True)
-@click.option('--region','-r', help='Anypoint MQ region', envvar='MQ_REGION', type=click.Choice(["us-east-1", "us-west-2", "ca-central-1", "eu-west-1", "eu-west-2", "ap-southeast-1", "ap-southeast-2"], case_sensitive=True))
-@click.option('--organization-id', 'orgId', help='Anypoint organization id (business group id)', envvar='MQ_ORG_ID')
-@click.option('--environment-id', 'envId', help='Anypoint environment id', envvar='MQ_ENV_ID')
-@click.option('--conf-path', 'confPath', help='Path from where to load the exported conf files', envvar='CONF_PATH')
-def importConf(username, password, region, orgId, envId, confPath):
-    """This search and return queues, exchanges, fifo queues and bindings corresponding to the given region, org id and environment id and exports them to a json file"""
+@cli.command()
+@targetOptions(broker=True)
+@option('--dead-letter-queue', 'dlq', help='Dead letter queue the messages are moved from', required=True)
+@option('--source', 'source', help='Queue the messages are moved to, by default the only queue in the DLQ deadLetterSources', required=False)
+@option('--prefetch', 'prefetch', help='Messages pulled and locked ahead, in batches of --batch-size', required=False, default=BROKER_BATCH_SIZE, type=click.IntRange(min=1))
+@option('--batch-size', 'batchSize', help='Messages per pull and publish request', required=False, default=BROKER_BATCH_SIZE, type=click.IntRange(min=1, max=BROKER_BATCH_SIZE))
+@option('--lock-ttl', 'lockTtl', help='Milliseconds a pulled message stays locked, the DLQ defaultLockTtl by default', required=False, type=click.IntRange(min=1))
+@option('--rate', 'rate', help='Maximum messages moved per second, unlimited by default', required=False, type=click.FloatRange(min=0, min_open=True))
+@option('--max-messages', 'maxMessages', help='Stop after this many messages', required=False, type=click.IntRange(min=1))
+@option('--timeout', 'timeout', help='Stop pulling after this many seconds', required=False, type=click.FloatRange(min=0))
+@concurrencyOption('Number of batches published and acknowledged in parallel')
+@option('--cursor', 'cursorPath', help='File recording the messages already moved, under the mq cache directory by default', required=False)
+@option('--resume', 'resume', help='Only acknowledge, without publishing them again, the DLQ messages the cursor records as moved', is_flag=True)
+def redrive(username, password, clientId, clientSecret, region, orgId, envId, dlq, source, prefetch, batchSize, lockTtl, rate, maxMessages, timeout, concurrency, cursorPath, resume):
+    """This command moves the messages of a dead letter queue back to its source queue: batches are pulled from the DLQ, published to the source and only then acknowledged,
+    with several batches in flight. It stops when the DLQ is empty, at --max-messages, --timeout or the first failed publish. Throughput is printed to stderr as it runs"""
+
+    #### The source queue comes from the DLQ deadLetterSources, through the admin API ####
+    if source is None:
+        source = redriveSource_util(MQClient(login(username, password), region, orgId, envId), dlq)
+
+    #### Broker login, with the client app credentials ####
+    broker = BrokerClient(brokerLogin(region, clientId, clientSecret), region, orgId, envId)
+
+    cursor = RedriveCursor(cursorPath or os.path.join(cacheDir(), 'redrive', orgId + '_' + envId + '_' + region + '_' + dlq + '.ndjson'), resume)
+    with cursor:
+        redrive_util(broker, dlq, source, cursor, prefetch, batchSize, lockTtl, rate, maxMessages, timeout, concurrency)
 
-    #### Anypoint login ####
-    token = login(username, password)
 
-#### FIRST WE GENERATE THE DLQs, AS THOSE NEED TO EXIST BEFORE ASSIGNATION TO REGULAR QUEUES AS DLQs
-    print("Importing DLQs")
-    for file in os.listdir("" + confPath):
-     
-        if file.startswith("queue-dlq_"):
-                print(os.path.join("", file)) 
-                with open(confPath + "/" + file) as json_file:
-                    bindings_array = []
-                    item = json.load(json_file)
-
-                    if(not hasattr(item, 'deadLetterQueueId')):
-                        deadLetterQueueId = ''
-                    else:
-                        deadLetterQueueId = item['deadLetterQueueId']
-                    if(not hasattr(item, 'maxDeliveries')):
-                        maxdeliv = 10
-                    else:
-                        maxdeliv = item['maxDeliveries']
+@cli.command()
+@targetOptions()
+@option('--file', 'file', help='NDJSON file with one operation per line, stdin by default', required=False, default='-', type=click.File('r'))
+@concurrencyOption('Number of operations executed in parallel')
+def batch(username, password, region, orgId, envId, file, concurrency):
+    """This command executes many operations, read as NDJSON lines like {"op": "create-queue", "name": "myQueue"}, with a single login and connection pool.
+    Operation fields are the long option names of the matching command. One NDJSON result is printed per operation, in input order"""
 
-                    result = createQueue_util(token, region, orgId, envId, item['queueId'], item['fifo'], item['defaultTtl'], item['defaultLockTtl'],  item['encrypted'], deadLetterQueueId , maxdeliv , item['defaultDeliveryDelay'])
+    #### Anypoint login ####
+    client = MQClient(login(username, password), region, orgId, envId)
 
+    lines = ((number, line) for number, line in enumerate(file, start=1) if line.strip())
+    failures = 0
+    with client.index.deferred(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Results are printed in input order as they complete, while later operations are still being read #
+        for result in boundedMap_util(executor, lambda numbered: batchOperation_util(client, numbered[0], numbered[1]), lines, concurrency * 2):
+            if not result['success']:
+                failures += 1
+            print(json.dumps(result), flush=True)
 
-#### THEN WE DEFINE REGULAR QUEUES
-    print("Importing Queues")
-    for file in os.listdir("" + confPath):
-     
-        if file.startswith("queue_"):
-                print(os.path.join("", file)) 
-                with open(confPath + "/" + file) as json_file:
-                    item = json.load(json_file)
-                    if(not 'deadLetterQueueId' in item):
-                        deadLetterQueueId = ''
-                    else:
-                        deadLetterQueueId = item['deadLetterQueueId']
-                    if(not 'maxDeliveries' in item):
-                        maxdeliv = 10
-                    else:
-                        maxdeliv = item['maxDeliveries']
-                    result = createQueue_util(token, region, orgId, envId, item['queueId'], item['fifo'], item['defaultTtl'], item['defaultLockTtl'],  item['encrypted'], deadLetterQueueId , maxdeliv , item['defaultDeliveryDelay'])
-
-
-#### THEN WE DEFINE EXCHANGES
-    print("Importing Exchanges")
-    for file in os.listdir("" + confPath):
-     
-        if file.startswith("exchange_"):
-                print(os.path.join("", file)) 
-                with open(confPath + "/" + file) as json_file:
-                    item = json.load(json_file)
-                    print(item)
-                    result = createExchange_util(token, region, orgId, envId, item['exchangeId'], item['encrypted'])
-
-#### THEN WE DEFINE THE BINDINGS
-    print("Importing Bindings")
-    for file in os.listdir("" + confPath):
-     
-        if file.startswith("bindings_"):
-                print(os.path.join("", file)) 
-                with open(confPath + "/" + file) as json_file:
-                    bindings_array = json.load(json_file)
-                    for item in bindings_array:
-                        result = bindQueues_util(token, region, orgId, envId, item['exchangeId'],  item['queueId'])
+    if failures:
+        raise Exception(str(failures) + ' batch operations failed')
 
-    print("Import Done")
-    
 
 ###### COMMANDS #####
 
 ###### UTILS #####
-def login(username, password):
+_session = None
 
-    # Try to get token from cache # 
-    cacheClient = memcache.Client(['memcached:11211'], debug=0)
-    tokenResponse = cacheClient.get(username + password)
+def loadRequests():
+    """This function imports requests, HTTPAdapter and HTTPError the first time a request is sent"""
+    global requests, HTTPAdapter, HTTPError
 
-    if tokenResponse is None:
-        login_url = "https://anypoint.mulesoft.com/accounts/login"
+    if requests is None:
+        import requests as requestsModule
+        from requests.adapters import HTTPAdapter
+        from requests.exceptions import HTTPError
+        requests = requestsModule
 
-        ###### GET TOKEN ######
-        payload = { "username": username, "password": password }
-        headers = { 'Content-Type': 'application/json' }
 
+def loadAsync():
+    """This function imports asyncio and httpx the first time the async backend is used"""
+    global asyncio, httpx
 
+    if httpx is None:
+        import asyncio as asyncioModule
         try:
-            tokenHTTPResponse = requests.request("POST", login_url, headers=headers, data=json.dumps(payload))
-            tokenHTTPResponse.raise_for_status()
+            import httpx as httpxModule
+        except ImportError:
+            raise Exception('The async backend requires httpx: pip install httpx')
+        asyncio = asyncioModule
+        httpx = httpxModule
 
-            tokenResponse = tokenHTTPResponse.json().get('access_token')
 
-            cacheClient.set(username + password, tokenResponse, 900)
-        except HTTPError as http_err:
-            raise Exception('HTTP error occurred: ' + str(http_err))
-        except Exception as err:
-            raise Exception('Other error occurred: ' + str(err))
+def getSession():
+    """This function returns the process wide HTTP session, so connections to Anypoint are kept alive and reused between calls"""
+    global _session
 
-    return tokenResponse   
+    if _session is None:
+        loadRequests()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
 
-#### Added by Geovani Osuna to reuse previously implemented functions - Util commands - bindQueues_util, createQueue_util and createExchange_util BEGIN ####
+    return _session
 
-def bindQueues_util(token, region, orgId, envId, name, queueName):
-    """This function creates an exchange in the given region, org id and environment id  """
 
-    #### Request destinations PUT to AMQ Rest API ####
+class RateLimiter:
+    """Client-side token bucket shared by every request of the process. A 429 with Retry-After pauses every caller"""
 
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/bindings/exchanges/' + name + '/queues/' + queueName
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    def __init__(self, rate, burst):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.burst = burst
+        self.nextSlot = 0
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes the next request slot and returns the seconds to wait for it"""
+
+        with self.lock:
+            now = time.monotonic()
+            # Slots left unused while idle are kept, up to <burst> requests sent back to back #
+            slot = max(self.nextSlot, now - (self.burst - 1) * self.interval, self.pausedUntil)
+            self.nextSlot = slot + self.interval
+        return max(slot - now, 0)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+
+
+class RetryBudget:
+    """Number of retries left for the whole run, so a failing platform is not hammered forever"""
+
+    def __init__(self, retries):
+        self.retries = retries
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
+
+
+_rateLimiter = None
+_retryBudget = None
+
+def getRateLimiter():
+    """This function returns the process wide rate limiter, configured with MQ_RATE_LIMIT (requests per second, 0 for unlimited) and MQ_RATE_BURST"""
+    global _rateLimiter
+
+    if _rateLimiter is None:
+        _rateLimiter = RateLimiter(float(os.environ.get('MQ_RATE_LIMIT', 0)), int(os.environ.get('MQ_RATE_BURST', 10)))
+
+    return _rateLimiter
+
+
+def getRetryBudget():
+    """This function returns the retry budget of the run, configured with MQ_RETRY_BUDGET"""
+    global _retryBudget
+
+    if _retryBudget is None:
+        _retryBudget = RetryBudget(int(os.environ.get('MQ_RETRY_BUDGET', 100)))
+
+    return _retryBudget
+
+
+class Metrics:
+    """Per-request metrics of a run: counts, statuses, bytes and latencies per method and templated endpoint, and token cache hits.
+    Every request is also written to the trace file as an NDJSON event when there is one"""
+
+    def __init__(self, traceFile=None):
+        self.start = time.time()
+        self.endpoints = {}
+        self.tokenCache = {'hit': 0, 'miss': 0}
+        self.traceFile = traceFile
+        self.lock = threading.Lock()
+
+    def record(self, method, url, status, bytesSent, bytesReceived, seconds, attempt, error=None):
+        path = urlsplit(url).path
+        endpoint = endpointTemplate(path)
+        with self.lock:
+            stats = self.endpoints.setdefault((method, endpoint), {'statuses': {}, 'errors': 0, 'bytesSent': 0, 'bytesReceived': 0, 'latencies': []})
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['errors'] += error is not None or status >= 400
+            stats['bytesSent'] += bytesSent
+            stats['bytesReceived'] += bytesReceived
+            stats['latencies'].append(seconds)
+            if self.traceFile is not None:
+                self.traceFile.write(json.dumps({"ts": round(time.time(), 6), "method": method, "endpoint": endpoint, "path": path, "status": status,
+                    "bytesSent": bytesSent, "bytesReceived": bytesReceived, "seconds": round(seconds, 6), "attempt": attempt, "error": error}) + '\n')
+                self.traceFile.flush()
+
+    def recordTokenCache(self, hit):
+        with self.lock:
+            self.tokenCache['hit' if hit else 'miss'] += 1
+
+    def summary(self):
+        """Returns the --metrics json summary"""
+
+        endpoints = []
+        with self.lock:
+            for (method, endpoint), stats in sorted(self.endpoints.items()):
+                latencies = sorted(stats['latencies'])
+                endpoints.append({"method": method, "endpoint": endpoint, "count": len(latencies), "errors": stats['errors'], "statuses": stats['statuses'],
+                    "bytesSent": stats['bytesSent'], "bytesReceived": stats['bytesReceived'], "latency": {
+                        "sum": round(sum(latencies), 6), "p50": round(latencies[int(0.5 * (len(latencies) - 1))], 6),
+                        "p99": round(latencies[int(0.99 * (len(latencies) - 1))], 6), "max": round(latencies[-1], 6),
+                        "buckets": dict([(str(bound), sum(1 for value in latencies if value <= bound)) for bound in LATENCY_BUCKETS] + [('+Inf', len(latencies))])}})
+            return {"wallSeconds": round(time.time() - self.start, 6), "requests": sum(item['count'] for item in endpoints),
+                "tokenCache": dict(self.tokenCache), "endpoints": endpoints}
+
+    def prometheus(self):
+        """Returns the --metrics prom summary, in the Prometheus text exposition format"""
+
+        summary = self.summary()
+        lines = ['# TYPE mq_http_requests_total counter']
+        for item in summary['endpoints']:
+            for status, count in sorted(item['statuses'].items()):
+                lines.append('mq_http_requests_total{method="%s",endpoint="%s",status="%s"} %d' % (item['method'], item['endpoint'], status, count))
+        lines.append('# TYPE mq_http_request_duration_seconds histogram')
+        for item in summary['endpoints']:
+            labels = 'method="%s",endpoint="%s"' % (item['method'], item['endpoint'])
+            for bound, count in item['latency']['buckets'].items():
+                lines.append('mq_http_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+            lines.append('mq_http_request_duration_seconds_sum{%s} %s' % (labels, item['latency']['sum']))
+            lines.append('mq_http_request_duration_seconds_count{%s} %d' % (labels, item['count']))
+        lines.append('# TYPE mq_http_bytes_total counter')
+        for item in summary['endpoints']:
+            for direction, key in (('sent', 'bytesSent'), ('received', 'bytesReceived')):
+                lines.append('mq_http_bytes_total{method="%s",endpoint="%s",direction="%s"} %d' % (item['method'], item['endpoint'], direction, item[key]))
+        lines.append('# TYPE mq_token_cache_total counter')
+        for result, count in sorted(summary['tokenCache'].items()):
+            lines.append('mq_token_cache_total{result="%s"} %d' % (result, count))
+        lines.append('# TYPE mq_run_duration_seconds gauge')
+        lines.append('mq_run_duration_seconds %s' % summary['wallSeconds'])
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = None
+
+def enableMetrics(enabled, traceFile=None):
+    """This function starts (or, when not enabled, stops) recording the metrics of the run and returns them"""
+    global _metrics
+
+    _metrics = Metrics(traceFile) if enabled else None
+    return _metrics
+
+
+def getMetrics():
+    """This function returns the metrics of the run, None unless --metrics or --trace is given"""
+    return _metrics
+
+
+def endpointTemplate(path):
+    """This function returns the endpoint of a URL path with its ids replaced by placeholders, e.g. /destinations/queues/{queueId}"""
+
+    segments = path.split('/')
+    for i in range(1, len(segments)):
+        placeholder = ENDPOINT_PLACEHOLDERS.get(segments[i - 1])
+        if placeholder is not None and segments[i] and segments[i] not in ENDPOINT_PLACEHOLDERS:
+            segments[i] = placeholder
+    endpoint = '/'.join(segments)
+    prefix = '/mq/admin/api/v1/organizations/{orgId}/environments/{envId}/regions/{region}'
+    return endpoint[len(prefix):] if endpoint.startswith(prefix + '/') else endpoint
+
+
+def requestSize(kwargs):
+    """This function returns the body size of a request sent with data or content"""
+
+    body = kwargs.get('data') if kwargs.get('data') is not None else kwargs.get('content')
+    return len(body.encode() if isinstance(body, str) else body) if body is not None else 0
+
+
+def responseSize(response, stream=False):
+    """This function returns the body size of a response, from Content-Length when the body is streamed"""
+
+    if response is None:
+        return 0
+    if stream:
+        return int(response.headers.get('Content-Length') or 0)
+    return len(response.content)
+
+
+def writeMetrics_util(metrics, format, path=None):
+    """This function writes the --metrics summary to path, or to stderr"""
+
+    output = json.dumps(metrics.summary()) + '\n' if format == 'json' else metrics.prometheus()
+    if path:
+        with open(path, 'w') as outfile:
+            outfile.write(output)
+    else:
+        click.echo(output, err=True, nl=False)
 
-    payload = {}
 
-    try:
-        response = requests.request(
-        "PUT", mq_request_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+def retryDelay(response, attempt):
+    """This function returns the seconds to wait before retrying: the server Retry-After when present,
+    otherwise a jittered exponential backoff"""
 
+    retryAfter = response.headers.get('Retry-After') if response is not None else None
+    if retryAfter:
+        try:
+            return min(float(retryAfter), RETRY_MAX_DELAY)
+        except ValueError:
+            try:
+                from email.utils import parsedate_to_datetime
+                return min(max(parsedate_to_datetime(retryAfter).timestamp() - time.time(), 0), RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
 
-    #### Build payload to return ####
-    print(json.dumps({   
-        "success": True,
-        "message": queueName + " was successfully binded to " + name
-    })) 
+    return random.uniform(0, min(RETRY_BACKOFF * (2 ** attempt), RETRY_MAX_DELAY))
 
-def createQueue_util(token, region, orgId, envId, name, fifo=False, ttl=120000, lockTtl=10000, encrypted=False, deadLetterQueue=False, maxAttempts=False, deliveryDelay=False):
-    """This function creates a queue (standard or FIFO) in the given region, org id and environment id """
 
-    #### Request destinations PUT to AMQ Rest API ####
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/queues/' + name
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+def httpRequest(method, url, **kwargs):
+    """This function sends a request through the pooled session. Requests are throttled by the rate limiter and retried on
+    429, 5xx and connection errors, up to MQ_MAX_RETRIES times while the run's retry budget lasts.
+    HTTPError is raised when the final response is not successful"""
 
-    if ((deadLetterQueue != '') and (maxAttempts != '')) and ((deadLetterQueue != None) and (maxAttempts != None)):
-        payload = {
-        "defaultTtl" : ttl,
+    session = getSession()
+    maxRetries = int(os.environ.get('MQ_MAX_RETRIES', 5))
+    attempt = 0
+    while True:
+        getRateLimiter().acquire()
+        sent = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=HTTP_TIMEOUT, **kwargs)
+            error = None
+        except (requests.ConnectionError, requests.Timeout) as err:
+            response = None
+            error = err
+
+        metrics = getMetrics()
+        if metrics is not None:
+            metrics.record(method, url, response.status_code if response is not None else 0, requestSize(kwargs),
+                responseSize(response, kwargs.get('stream')), time.perf_counter() - sent, attempt, str(error) if error is not None else None)
+
+        retryable = error is not None or response.status_code in RETRY_STATUSES
+        if not retryable or attempt >= maxRetries or not getRetryBudget().take():
+            if error is not None:
+                raise error
+            response.raise_for_status()
+            return response
+
+        delay = retryDelay(response, attempt)
+        if response is not None:
+            response.close()
+            if response.status_code == 429:
+                getRateLimiter().pause(delay)
+        attempt += 1
+        time.sleep(delay)
+
+
+def iterJsonArray_util(response, chunkSize=STREAM_CHUNK_SIZE):
+    """This function is a generator over the items of a JSON array response body. The body is parsed incrementally as its
+    chunks arrive, so only the current chunk and item are held in memory. The response is closed once consumed"""
+
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    separators = re.compile(r'[\s,]*')
+    whitespace = re.compile(r'\s*')
+    buffer = ''
+    started = False
+    try:
+        for chunk in withEnd_util(response.iter_content(chunk_size=chunkSize)):
+            last = chunk is None
+            buffer += text.decode(b'' if last else chunk, final=last)
+            pos = 0
+            while True:
+                pos = separators.match(buffer, pos).end()
+                if pos == len(buffer):
+                    break
+                if not started:
+                    if buffer[pos] != '[':
+                        raise ValueError('Expected a JSON array')
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == ']':
+                    return
+                # An incomplete item fails to decode, or decodes to a prefix of itself (a number cut at a chunk boundary), so an item
+                # is only taken once the separator after it is buffered #
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if last:
+                        raise
+                    break
+                after = whitespace.match(buffer, end).end()
+                if after == len(buffer) or buffer[after] not in ',]':
+                    if last:
+                        raise ValueError('Expected , or ] after an item')
+                    break
+                pos = end
+                yield item
+            buffer = buffer[pos:]
+        raise ValueError('Truncated JSON array')
+    finally:
+        response.close()
+
+
+def withEnd_util(chunks):
+    """This function yields the given chunks followed by None, marking the end of the stream"""
+
+    yield from chunks
+    yield None
+
+
+def boundedMap_util(executor, fn, items, window):
+    """This function works like executor.map, results come in input order, but keeps at most <window> items in flight,
+    so a streamed input is consumed as results are used instead of being read upfront"""
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        # Results already done are yielded before the next item is read, so a slow input does not hold them back #
+        while pending and (len(pending) >= window or pending[0].done()):
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def cacheDir():
+    """This function returns the directory where mq keeps its local caches"""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'mq')
+
+
+class DestinationsIndex:
+    """Local snapshot of the /destinations listing of a region, org id and environment id.
+    Lookups are answered from it while it is younger than its TTL, then it is revalidated with a single listing"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.data = None
+        self.deferredSave = False
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def enabled(self):
+        return self.ttl > 0
+
+    def load(self):
+        if self.data is None:
+            try:
+                with open(self.path) as index_file:
+                    self.data = json.load(index_file)
+            except (OSError, ValueError):
+                self.data = None
+        return self.data
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmpPath = self.path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmpPath, 'w') as index_file:
+            json.dump(self.data, index_file)
+        os.replace(tmpPath, self.path)
+        self.dirty = False
+
+    def destinations(self, client, refresh=False):
+        """Returns the destinations listing, from the index when it is fresh, otherwise from the admin API"""
+
+        with self.lock:
+            data = self.load()
+            if data is not None and not refresh and time.time() - data['fetchedAt'] < self.ttl:
+                return data['destinations']
+
+            # Revalidated with the listing ETag, so an unchanged listing is not downloaded again #
+            headers = dict(client.headers)
+            if data is not None and data.get('etag') and not refresh:
+                headers['If-None-Match'] = data['etag']
+            response = httpRequest("GET", client.baseUrl + '/destinations', headers=headers, stream=True)
+
+            if response.status_code == 304:
+                response.close()
+                data['fetchedAt'] = time.time()
+            else:
+                self.data = data = {'fetchedAt': time.time(), 'etag': response.headers.get('ETag'), 'destinations': list(iterJsonArray_util(response))}
+            self.save()
+            return data['destinations']
+
+    def apply(self, kind, name, destination):
+        """Updates an existing index after a mutation, destination None removes it"""
+
+        with self.lock:
+            data = self.load()
+            if data is None:
+                return
+            idKey = 'queueId' if kind == 'queue' else 'exchangeId'
+            kept = [value for value in data['destinations'] if not (value.get('type') == kind and value.get(idKey) == name)]
+            if destination is not None:
+                previous = next((value for value in data['destinations'] if value.get('type') == kind and value.get(idKey) == name), {})
+                merged = dict(previous)
+                merged.update(destination)
+                merged.update({'type': kind, idKey: name})
+                kept.append(merged)
+            data['destinations'] = kept
+            self.dirty = True
+            if not self.deferredSave:
+                self.save()
+
+    @contextmanager
+    def deferred(self):
+        """Saves the index once at the end of a bulk operation instead of after every mutation"""
+
+        with self.lock:
+            self.deferredSave = True
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.deferredSave = False
+                if self.dirty:
+                    self.save()
+
+
+def requestError(err):
+    """This function returns the exception raised by the util functions when their admin API request fails"""
+
+    if isinstance(err, HTTPError):
+        return Exception('HTTP error occurred: ' + str(err))
+    return Exception('Other error occurred: ' + str(err))
+
+
+def requestResult(client, spec, response):
+    """This function applies a successful util function request to the destinations index and returns the util result:
+    its success message, or the response body when the request has no message"""
+
+    if 'index' in spec:
+        client.index.apply(*spec['index'])
+    if 'message' not in spec:
+        return response.json()
+
+    return {
+        "success": True,
+        "message": spec['message']
+    }
+
+
+class MQClient:
+    """Anypoint MQ admin API client for a given region, org id and environment id.
+    Every client shares the pooled session returned by getSession"""
+
+    def __init__(self, token, region, orgId, envId):
+        self.region = region
+        self.orgId = orgId
+        self.envId = envId
+        self.index = DestinationsIndex(os.path.join(cacheDir(), 'destinations', orgId + '_' + envId + '_' + region + '.json'),
+            float(os.environ.get('MQ_INDEX_TTL', INDEX_DEFAULT_TTL)))
+        self.baseUrl = ANYPOINT_URL + '/mq/admin/api/v1/organizations/' + \
+            orgId + '/environments/' + envId + '/regions/' + region
+        self.headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
+               token}
+        self.statsUrl = ANYPOINT_URL + '/mq/stats/api/v1/organizations/' + \
+            orgId + '/environments/' + envId + '/regions/' + region
+
+    def request(self, method, path, payload=None, stream=False):
+        """Sends a request to the admin API through httpRequest, raising HTTPError when the response is not successful.
+        With stream the body is downloaded as it is read, see iterJsonArray_util"""
+
+        data = json.dumps(payload) if payload is not None else None
+        return httpRequest(method, self.baseUrl + path, headers=self.headers, data=data, stream=stream)
+
+    def send(self, spec):
+        """Sends the request of a util function and returns the util result, see requestResult. The request is a dict with
+        its method, path, optional payload, optional destinations index update (kind, name, payload) and optional success message.
+        With an AsyncMQClient the same util functions return a coroutine instead"""
+
+        try:
+            response = self.request(spec['method'], spec['path'], spec.get('payload'))
+        except Exception as err:
+            raise requestError(err)
+        return requestResult(self, spec, response)
+
+    def stats(self, path, params):
+        """Sends a GET request to the stats API through httpRequest, raising HTTPError when the response is not successful"""
+        return httpRequest("GET", self.statsUrl + path, headers=self.headers, params=params)
+
+
+async def asyncHttpRequest(http, method, url, **kwargs):
+    """This function is the asyncio counterpart of httpRequest, sent through an httpx.AsyncClient. It shares the rate limiter,
+    retries and retry budget of httpRequest and raises the same requests exceptions, so callers handle both backends alike"""
+
+    maxRetries = int(os.environ.get('MQ_MAX_RETRIES', 5))
+    attempt = 0
+    while True:
+        delay = getRateLimiter().reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+            error = None
+        except httpx.TransportError as err:
+            response = None
+            error = err
+
+        metrics = getMetrics()
+        if metrics is not None:
+            metrics.record(method, url, response.status_code if response is not None else 0, requestSize(kwargs),
+                responseSize(response), time.perf_counter() - sent, attempt, (str(error) or type(error).__name__) if error is not None else None)
+
+        retryable = error is not None or response.status_code in RETRY_STATUSES
+        if not retryable or attempt >= maxRetries or not getRetryBudget().take():
+            if error is not None:
+                raise requests.ConnectionError(str(error) or type(error).__name__)
+            if response.is_error:
+                raise HTTPError(str(response.status_code) + ' ' + response.reason_phrase + ' for url: ' + str(response.url), response=response)
+            return response
+
+        delay = retryDelay(response, attempt)
+        if response is not None and response.status_code == 429:
+            getRateLimiter().pause(delay)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+class AsyncMQClient:
+    """asyncio counterpart of MQClient, on httpx, used by the bulk commands with --backend async. It is used like a ThreadPoolExecutor:
+    submit and map run coroutine functions fn(asyncClient, item) on a single event loop thread, where a semaphore caps the requests in flight"""
+
+    def __init__(self, client, limit):
+        loadAsync()
+        loadRequests()
+        self.client = client
+        self.index = client.index
+        self.limit = limit
+        self.loop = None
+        self.thread = None
+        self.http = None
+        self.semaphore = None
+
+    async def request(self, method, path, payload=None):
+        """Sends a request to the admin API through asyncHttpRequest, raising HTTPError when the response is not successful"""
+
+        data = json.dumps(payload) if payload is not None else None
+        async with self.semaphore:
+            return await asyncHttpRequest(self.http, method, self.client.baseUrl + path, headers=self.client.headers, content=data)
+
+    async def send(self, spec):
+        """Async twin of MQClient.send"""
+
+        try:
+            response = await self.request(spec['method'], spec['path'], spec.get('payload'))
+        except Exception as err:
+            raise requestError(err)
+        return requestResult(self, spec, response)
+
+    def submit(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(fn(self, *args), self.loop)
+
+    def map(self, fn, items):
+        """Returns the results in input order, keeping at most twice <limit> items in flight, see boundedMap_util"""
+        return boundedMap_util(self, fn, items, self.limit * 2)
+
+    async def open(self):
+        self.semaphore = asyncio.Semaphore(self.limit)
+        self.http = httpx.AsyncClient(limits=httpx.Limits(max_connections=self.limit, max_keepalive_connections=min(self.limit, HTTP_POOL_SIZE)),
+            timeout=httpx.Timeout(HTTP_TIMEOUT[1], connect=HTTP_TIMEOUT[0]))
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.http.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        return False
+
+
+def bulkExecutor_util(client, backend, concurrency):
+    """This function returns the executor of a bulk command: a ThreadPoolExecutor with <concurrency> workers,
+    or with the async backend an AsyncMQClient with <concurrency> requests in flight"""
+
+    if backend == 'async':
+        return AsyncMQClient(client, concurrency)
+    return ThreadPoolExecutor(max_workers=concurrency)
+
+
+def brokerUrl(region):
+    """This function returns the broker API base URL of a region"""
+    return BROKER_URL.format(region=region) + '/api/v1'
+
+
+class BrokerClient:
+    """Anypoint MQ broker API client (messages) for a given region, org id and environment id.
+    It shares the pooled session, retries and rate limiter of MQClient"""
+
+    def __init__(self, token, region, orgId, envId):
+        self.region = region
+        self.orgId = orgId
+        self.envId = envId
+        self.baseUrl = brokerUrl(region) + '/organizations/' + orgId + '/environments/' + envId
+        self.headers = {'Authorization': 'bearer ' + token, 'Content-Type': 'application/json'}
+
+    def request(self, method, path, payload=None, params=None):
+        """Sends a request to the broker API through httpRequest, raising HTTPError when the response is not successful"""
+
+        data = json.dumps(payload) if payload is not None else None
+        return httpRequest(method, self.baseUrl + path, headers=self.headers, data=data, params=params)
+
+
+@contextmanager
+def tokenLock_util(cache, key, tryAcquire, release):
+    """This function waits until the refresh lock is taken, another invocation cached the token or TOKEN_LOCK_TIMEOUT expires,
+    so concurrent invocations with a cold cache log in only once"""
+
+    deadline = time.time() + TOKEN_LOCK_TIMEOUT
+    acquired = tryAcquire()
+    while not acquired and time.time() < deadline and cache.get(key) is None:
+        time.sleep(TOKEN_LOCK_POLL)
+        acquired = tryAcquire()
+
+    try:
+        yield
+    finally:
+        if acquired:
+            release()
+
+
+class MemoryTokenCache:
+    """In-process LRU token cache, useful for long running processes that log in several times"""
+
+    def __init__(self, maxSize=TOKEN_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.refreshLock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, token, ttl):
+        with self.lock:
+            self.entries[key] = (token, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def refreshing(self, key):
+        return tokenLock_util(self, key, lambda: self.refreshLock.acquire(blocking=False), self.refreshLock.release)
+
+
+class FileTokenCache:
+    """On-disk token cache readable only by the current user, so separate CLI invocations can skip the login"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self.load().get(key)
+        if entry is None or entry['expiresAt'] <= time.time():
+            return None
+        return entry['token']
+
+    def set(self, key, token, ttl):
+        now = time.time()
+        entries = {k: v for k, v in self.load().items() if v['expiresAt'] > now}
+        entries[key] = {'token': token, 'expiresAt': now + ttl}
+
+        #### Written to a private temp file and renamed, so readers never see a partial cache ####
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmpPath = self.path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(tmpPath, self.path)
+
+    def refreshing(self, key):
+        if fcntl is None:
+            return nullcontext()
+
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+
+        def tryAcquire():
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                return False
+
+        def release():
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        @contextmanager
+        def locked():
+            try:
+                with tokenLock_util(self, key, tryAcquire, release):
+                    yield
+            finally:
+                os.close(fd)
+
+        return locked()
+
+
+class MemcachedTokenCache:
+    """Memcached token cache, shared by every host pointing at the same memcached servers"""
+
+    def __init__(self, servers):
+        import memcache
+        self.client = memcache.Client(servers, debug=0, socket_timeout=1)
+
+    def available(self):
+        return any(server.connect() for server in self.client.servers)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, token, ttl):
+        self.client.set(key, token, int(ttl))
+
+    def refreshing(self, key):
+        lockKey = key + ':lock'
+        return tokenLock_util(self, key, lambda: bool(self.client.add(lockKey, os.getpid(), int(TOKEN_LOCK_TIMEOUT))), lambda: self.client.delete(lockKey))
+
+
+class NoTokenCache:
+    """Disabled token cache, every invocation logs in"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, token, ttl):
+        pass
+
+    def refreshing(self, key):
+        return nullcontext()
+
+
+_memoryTokenCache = MemoryTokenCache()
+_tokenCache = None
+
+def getTokenCache():
+    """This function returns the token cache selected by MQ_TOKEN_CACHE (memcached, file, memory or none).
+    When memcached is selected but not reachable the file cache is used instead"""
+    global _tokenCache
+
+    if _tokenCache is None:
+        backend = os.environ.get('MQ_TOKEN_CACHE', 'memcached')
+        filePath = os.environ.get('MQ_TOKEN_CACHE_PATH', os.path.join(cacheDir(), 'tokens.json'))
+
+        if backend == 'memcached':
+            cache = MemcachedTokenCache(os.environ.get('MQ_MEMCACHED_SERVERS', 'memcached:11211').split(','))
+            _tokenCache = cache if cache.available() else FileTokenCache(filePath)
+        elif backend == 'file':
+            _tokenCache = FileTokenCache(filePath)
+        elif backend == 'memory':
+            _tokenCache = _memoryTokenCache
+        elif backend == 'none':
+            _tokenCache = NoTokenCache()
+        else:
+            raise Exception('Unknown token cache backend: ' + backend)
+
+    return _tokenCache
+
+
+def tokenCacheSecret():
+    """This function returns the secret the token cache keys are signed with: MQ_TOKEN_CACHE_SECRET, so several hosts share a memcached
+    cache, or a random secret of this host kept in the cache dir, readable only by the current user"""
+
+    secret = os.environ.get('MQ_TOKEN_CACHE_SECRET')
+    if secret:
+        return secret.encode()
+
+    path = os.path.join(cacheDir(), 'token.secret')
+    if not os.path.exists(path):
+        #### Written to a private temp file and linked, so concurrent invocations all end up with the first secret ####
+        os.makedirs(cacheDir(), mode=0o700, exist_ok=True)
+        tmpPath = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as secret_file:
+            secret_file.write(os.urandom(32))
+        try:
+            os.link(tmpPath, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmpPath)
+
+    with open(path, 'rb') as secret_file:
+        return secret_file.read()
+
+
+def tokenCacheKey(username, password, url=ANYPOINT_URL):
+    """This function returns the cache key of a user's (or client app's) token: an HMAC of the credentials keyed by tokenCacheSecret,
+    so the cache holds neither the credentials nor a hash that could be brute forced without the secret"""
+    import hmac
+
+    digest = hmac.new(tokenCacheSecret(), (url + '\0' + username + '\0' + password).encode(), hashlib.sha256).hexdigest()
+    return 'mq:token:' + digest
+
+
+def login(username, password):
+
+    def fetch():
+        login_url = ANYPOINT_URL + "/accounts/login"
+
+        ###### GET TOKEN ######
+        payload = { "username": username, "password": password }
+        headers = { 'Content-Type': 'application/json' }
+
+
+        try:
+            tokenHTTPResponse = httpRequest("POST", login_url, headers=headers, data=json.dumps(payload))
+
+            tokenJson = tokenHTTPResponse.json()
+            return tokenJson.get('access_token'), tokenJson.get('expires_in')
+        except HTTPError as http_err:
+            raise Exception('HTTP error occurred: ' + str(http_err))
+        except Exception as err:
+            raise Exception('Other error occurred: ' + str(err))
+
+    return cachedToken_util(tokenCacheKey(username, password), fetch)
+
+
+def brokerLogin(region, clientId, clientSecret):
+    """This function returns the broker API token of an MQ client app, cached like the login token"""
+
+    def fetch():
+        payload = {"client_id": clientId, "client_secret": clientSecret, "grant_type": "client_credentials"}
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        try:
+            tokenJson = httpRequest("POST", brokerUrl(region) + '/authorize', headers=headers, data=urlencode(payload)).json()
+            return tokenJson.get('access_token'), tokenJson.get('expires_in')
+        except HTTPError as http_err:
+            raise Exception('HTTP error occurred: ' + str(http_err))
+        except Exception as err:
+            raise Exception('Other error occurred: ' + str(err))
+
+    return cachedToken_util(tokenCacheKey(clientId, clientSecret, brokerUrl(region)), fetch)
+
+
+def cachedToken_util(cacheKey, fetch):
+    """This function returns the token cached under cacheKey, or the (token, expires_in) returned by fetch, which is then cached"""
+
+    # Try to get token from the in-process cache first, then from the configured cache # 
+    metrics = getMetrics()
+    tokenResponse = _memoryTokenCache.get(cacheKey)
+    if tokenResponse is not None:
+        if metrics is not None:
+            metrics.recordTokenCache(True)
+        return tokenResponse
+
+    cacheClient = getTokenCache()
+    tokenResponse = cacheClient.get(cacheKey)
+
+    if tokenResponse is not None:
+        _memoryTokenCache.set(cacheKey, tokenResponse, TOKEN_EXPIRY_MARGIN)
+        if metrics is not None:
+            metrics.recordTokenCache(True)
+        return tokenResponse
+
+    # Only one invocation refreshes the token, the others wait for it to show up in the cache #
+    with cacheClient.refreshing(cacheKey):
+        tokenResponse = cacheClient.get(cacheKey)
+        if tokenResponse is not None:
+            _memoryTokenCache.set(cacheKey, tokenResponse, TOKEN_EXPIRY_MARGIN)
+            if metrics is not None:
+                metrics.recordTokenCache(True)
+            return tokenResponse
+
+        if metrics is not None:
+            metrics.recordTokenCache(False)
+        tokenResponse, expiresIn = fetch()
+
+        # Cache the token for its real lifetime, minus a margin so it is not used right when it expires #
+        ttl = max(int(expiresIn or TOKEN_DEFAULT_TTL) - TOKEN_EXPIRY_MARGIN, 1)
+        cacheClient.set(cacheKey, tokenResponse, ttl)
+        _memoryTokenCache.set(cacheKey, tokenResponse, ttl)
+
+    return tokenResponse   
+
+#### Added by Geovani Osuna to reuse previously implemented functions - Util commands - bindQueues_util, createQueue_util and createExchange_util BEGIN ####
+
+def bindQueues_util(client, name, queueName):
+    """This function creates an exchange in the given region, org id and environment id  """
+
+    #### Request destinations PUT to AMQ Rest API ####
+
+    return client.send({"method": "PUT", "path": '/bindings/exchanges/' + name + '/queues/' + queueName, "payload": {},
+        "message": queueName + " was successfully binded to " + name})
+
+def createQueue_util(client, name, fifo=False, ttl=120000, lockTtl=10000, encrypted=False, deadLetterQueue=False, maxAttempts=False, deliveryDelay=False):
+    """This function creates a queue (standard or FIFO) in the given region, org id and environment id """
+
+    #### Request destinations PUT to AMQ Rest API ####
+
+    payload = queuePayload_util(fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay)
+
+    return client.send({"method": "PUT", "path": '/destinations/queues/' + name, "payload": payload, "index": ('queue', name, payload),
+        "message": name + " was successfully created"})
+
+
+def queuePayload_util(fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay):
+    """This function returns the PUT payload of a queue"""
+
+    if ((deadLetterQueue != '') and (maxAttempts != '')) and ((deadLetterQueue != None) and (maxAttempts != None)):
+        payload = {
+        "defaultTtl" : ttl,
         "defaultLockTtl" : lockTtl,
         "encrypted" : encrypted,
         "fifo" : fifo,
@@ -700,54 +1688,1470 @@ def createQueue_util(token, region, orgId, envId, name, fifo=False, ttl=120000,
         "fifo" : fifo,
         "defaultDeliveryDelay": deliveryDelay
         }
-   
+
+    return payload
+
+
+def createExchange_util(client, name, encrypted):
+    """This function creates an exchange in the given region, org id and environment id  """
+
+    #### Request destinations PUT to AMQ Rest API ####
+
+    payload = {
+      "encrypted" : encrypted
+    }
+
+    return client.send({"method": "PUT", "path": '/destinations/exchanges/' + name, "payload": payload, "index": ('exchange', name, payload),
+        "message": name + " was successfully created"})
+
+#### Added by Geovani Osuna to reuse previously implemented functions - Util commands - bindQueues_util, createQueue_util and createExchange_util END ####
+
+def listEnvironments_util(token, orgId):
+    """This function returns the ids of the environments of the given org id"""
+
+    try:
+        response = httpRequest("GET", ANYPOINT_URL + '/accounts/api/organizations/' + orgId + '/environments', headers={'Authorization': 'bearer ' + token})
+    except HTTPError as http_err:
+        raise Exception('HTTP error occurred: ' + str(http_err))
+
+    return [environment['id'] for environment in response.json().get('data', [])]
+
+
+def resolveTargets_util(token, orgId, regions, envIds):
+    """This function returns the (region, environment id) pairs to query, all standing for every region or every environment of the org"""
+
+    regions = REGIONS if 'all' in regions else list(dict.fromkeys(regions))
+    envIds = parseNames_util(envIds)
+    if 'all' in envIds:
+        envIds = listEnvironments_util(token, orgId)
+    if not regions or not envIds:
+        raise click.UsageError('At least one --region and one --environment-id are required')
+
+    return [(region, envId) for region in regions for envId in envIds]
+
+
+def listDestinations_util(client, noCache=False, refresh=False):
+    """This function returns the destinations of the given region, org id and environment id, from the local index unless noCache is set.
+    Without the index the listing is streamed, so it can only be iterated once"""
+
     try:
-        response = requests.request(
-        "PUT", mq_request_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
+        if noCache or not client.index.enabled():
+            return iterJsonArray_util(client.request("GET", '/destinations', stream=True))
+        return client.index.destinations(client, refresh)
     except HTTPError as http_err:
         raise Exception('HTTP error occurred: ' + str(http_err))
     except Exception as err:
         raise Exception('Other error occurred: ' + str(err))
 
 
+def search_util(client, noCache=False, refresh=False):
+    """This function searches and yields queues, exchanges, fifo queues corresponding to the given region, org id and environment id,
+    as the destinations listing is read"""
+
+    #### Request destinations to AMQ Rest API ####
+    destinations = listDestinations_util(client, noCache, refresh)
+
     #### Build payload to return ####
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully created"
-    }))
+    for value in destinations:
+        yield {
+            "name": value.get('queueId') if value.get('queueId') != None else value.get('exchangeId'),
+            "fifo": value.get('fifo') if value.get('fifo') != None else False,
+            "exchange": True if value.get('type') == 'exchange' else False
+        }
 
 
-def createExchange_util(token, region, orgId, envId, name, encrypted):
-    """This function creates an exchange in the given region, org id and environment id  """
+def printJsonArray_util(items):
+    """This function prints items as a single JSON array, like print(json.dumps(list(items))), writing every item as soon as it is read"""
+
+    sys.stdout.write('[')
+    for number, item in enumerate(items):
+        sys.stdout.write((', ' if number else '') + json.dumps(item))
+    sys.stdout.write(']\n')
+
+
+def searchTargets_util(token, orgId, targets, noCache=False, refresh=False):
+    """This function searches every (region, environment id) target concurrently and prints one JSON line per destination, tagged with
+    its region and environment id. Targets are printed as soon as they answer, so a slow region does not hold the others back"""
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {executor.submit(lambda client: list(search_util(client, noCache, refresh)), MQClient(token, region, orgId, envId)): (region, envId) for region, envId in targets}
+        for future in as_completed(futures):
+            region, envId = futures[future]
+            try:
+                for value in future.result():
+                    print(json.dumps(dict(value, region=region, environmentId=envId)))
+            except Exception as err:
+                failures.append(region + '/' + envId)
+                print(json.dumps({"region": region, "environmentId": envId, "error": str(err)}))
+            sys.stdout.flush()
+
+    if failures:
+        raise Exception('Search failed for: ' + ', '.join(failures))
+
+
+def findDestination_util(client, kind, name, noCache=False, refresh=False):
+    """This function will try to find a queue or an exchange in a given region, org id and environment id"""
+
+    if noCache or not client.index.enabled():
+        #### Request destination to AMQ Rest API ####
+        try:
+            client.request("GET", '/destinations/' + kind + 's/' + name)
+            exists = True
+        except HTTPError as http_err:
+            if http_err.response.status_code == 404:
+                exists = False
+            else:
+                raise Exception('HTTP error occurred: ' + str(http_err))
+        except Exception as err:
+            raise Exception('Other error occurred: ' + str(err))
+    else:
+        idKey = 'queueId' if kind == 'queue' else 'exchangeId'
+        exists = any(value.get('type') == kind and value.get(idKey) == name for value in listDestinations_util(client, refresh=refresh))
+
+    if exists:
+        return {   
+            "exists": True,
+            "message": name + " already exists"
+        }
+    return {   
+        "exists": False,
+        "message": name + " does not exist"
+    }
+
+
+def findDestinations_util(client, kind, names, noCache=False, refresh=False):
+    """This function checks which of the given queue or exchange names exist, using a single destinations listing"""
+
+    idKey = 'queueId' if kind == 'queue' else 'exchangeId'
+    existing = set(value.get(idKey) for value in listDestinations_util(client, noCache, refresh) if value.get('type') == kind)
+
+    return {name: name in existing for name in names}
+
+
+def parseNames_util(values, namesFile=None):
+    """This function returns the names given as repeated and/or comma-separated values and in a file with one name per line, without duplicates"""
+
+    names = []
+    for value in values:
+        names.extend(value.split(','))
+    if namesFile is not None:
+        names.extend(namesFile.read().splitlines())
+
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+
+def findQueue_util(client, name, noCache=False, refresh=False):
+    """This function will try to find a queue in a given region, org id and environment id"""
+    return findDestination_util(client, 'queue', name, noCache, refresh)
+
+
+def findExchange_util(client, name, noCache=False, refresh=False):
+    """This function will try to find an exchange in a given region, org id and environment id"""
+    return findDestination_util(client, 'exchange', name, noCache, refresh)
+
+
+def updateQueue_util(client, name, fifo, ttl, lockTtl, encrypted, deadLetterQueue, maxAttempts, deliveryDelay):
+    """This function updates a queue (standard or FIFO) in the given region, org id and environment id """
 
     #### Request destinations PUT to AMQ Rest API ####
 
-    mq_request_url = 'https://anypoint.mulesoft.com/mq/admin/api/v1/organizations/' + \
-        orgId + '/environments/' + envId + '/regions/' + region + '/destinations/exchanges/' + name
-    headers = {'X-ANYPNT-ENV-ID': envId, 'Authorization': 'bearer ' +
-               token}
+    payload = {
+      "defaultTtl" : ttl,
+      "defaultLockTtl" : lockTtl,
+      "encrypted" : encrypted,
+      "fifo" : fifo,
+      "deadLetterQueueId": deadLetterQueue,
+      "maxDeliveries": maxAttempts,
+      "defaultDeliveryDelay": deliveryDelay
+    }
+
+    return client.send({"method": "PATCH", "path": '/destinations/queues/' + name, "payload": payload, "index": ('queue', name, payload),
+        "message": name + " was successfully updated"})
+
+
+def updateExchange_util(client, name, encrypted):
+    """This function updates an exchange in the given region, org id and environment id  """
+
+    #### Request destinations PUT to AMQ Rest API ####
 
     payload = {
       "encrypted" : encrypted
     }
 
-    try:
-        response = requests.request(
-        "PUT", mq_request_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-    except HTTPError as http_err:
-        raise Exception('HTTP error occurred: ' + str(http_err))
-    except Exception as err:
-        raise Exception('Other error occurred: ' + str(err))
+    return client.send({"method": "PATCH", "path": '/destinations/exchanges/' + name, "payload": payload, "index": ('exchange', name, payload),
+        "message": name + " was successfully updated"})
 
 
-    #### Build payload to return ####
-    print(json.dumps({   
-        "success": True,
-        "message": name + " was successfully created"
-    }))
+def unbindQueues_util(client, name, queueName):
+    """This function unbinds a queue from an exchange in the given region, org id and environment id  """
 
-#### Added by Geovani Osuna to reuse previously implemented functions - Util commands - bindQueues_util, createQueue_util and createExchange_util END ####
+    #### Request destinations PUT to AMQ Rest API ####
+
+    return client.send({"method": "DELETE", "path": '/bindings/exchanges/' + name + '/queues/' + queueName,
+        "message": queueName + " was successfully unbinded from " + name})
+
+
+def deleteQueue_util(client, name):
+    """This function deletes a queue in the given region, org id and environment id"""
+
+    #### Request destinations PUT to AMQ Rest API ####
+
+    return client.send({"method": "DELETE", "path": '/destinations/queues/' + name, "index": ('queue', name, None),
+        "message": name + " was successfully purged"})
+
+
+def deleteExchange_util(client, name):
+    """This function deletes an exchange in the given region, org id and environment id"""
+
+    #### Request destinations DELETE to AMQ Rest API ####
+
+    return client.send({"method": "DELETE", "path": '/destinations/exchanges/' + name, "index": ('exchange', name, None),
+        "message": name + " was successfully purged"})
+
+
+def purge_util(client, name):
+    """This function purges a queue in the given region, org id and environment id"""
+
+    #### Request destinations PUT to AMQ Rest API ####
+
+    return client.send({"method": "DELETE", "path": '/destinations/queues/' + name + '/messages',
+        "message": name + " was successfully purged"})
+
+
+def fanOutBindings_util(client, action, names, queueNames, concurrency, backend='threads'):
+    """This function runs bindQueues_util or unbindQueues_util for every exchange and queue pair, using up to <concurrency> workers,
+    or <concurrency> requests in flight with the async backend.
+    A single binding prints its result as before, several bindings print one JSON line per binding, in exchange and queue order"""
+
+    pairs = [(name, queueName) for name in names for queueName in queueNames]
+    if len(pairs) == 1:
+        print(json.dumps(action(client, pairs[0][0], pairs[0][1])))
+        return
+
+    def run(pair):
+        try:
+            return dict(action(client, pair[0], pair[1]), exchange=pair[0], queue=pair[1])
+        except Exception as err:
+            return {"success": False, "message": str(err), "exchange": pair[0], "queue": pair[1]}
+
+    async def runAsync(aclient, pair):
+        try:
+            return dict(await action(aclient, pair[0], pair[1]), exchange=pair[0], queue=pair[1])
+        except Exception as err:
+            return {"success": False, "message": str(err), "exchange": pair[0], "queue": pair[1]}
+
+    failures = 0
+    with bulkExecutor_util(client, backend, concurrency) as executor:
+        for result in executor.map(runAsync if backend == 'async' else run, pairs):
+            if not result['success']:
+                failures += 1
+            print(json.dumps(result), flush=True)
+
+    if failures:
+        raise Exception(str(failures) + ' of ' + str(len(pairs)) + ' bindings failed')
+
+
+def exportTarget_util(client, dir, format, concurrency, backend, label=''):
+    """This function exports the destinations and bindings of the client region and environment to dir, printing its progress
+    prefixed by label, and returns the path written, with the bundle suffix in bundle format, and the exchanges whose bindings could not be exported"""
+
+    #### Request destinations to AMQ Rest API ####
+
+    try:
+        destinations = iterJsonArray_util(client.request("GET", '/destinations', stream=True))
+    except HTTPError as http_err:
+        raise Exception('HTTP error occurred: ' + str(http_err))
+    except Exception as err:
+        raise Exception('Other error occurred: ' + str(err))
+
+    if format == 'bundle':
+        if not dir.endswith(BUNDLE_SUFFIX):
+            dir = dir + BUNDLE_SUFFIX
+        os.makedirs(os.path.dirname(dir) or '.', exist_ok=True)
+        writer = BundleExportWriter(dir, {"region": client.region, "organizationId": client.orgId, "environmentId": client.envId})
+    else:
+        writer = DirectoryExportWriter(dir)
+
+    print(label + "path:" + dir)
+
+    #### Write destinations and bindings as the listing streams in, in listing order, using up to <concurrency> workers ####
+    failures = []
+    with writer, bulkExecutor_util(client, backend, concurrency) as executor:
+        if backend == 'async':
+            results = executor.map(lambda aclient, value: exportDestinationAsync_util(aclient, writer, value), destinations)
+        else:
+            results = boundedMap_util(executor, lambda value: exportDestination_util(client, writer, value), destinations, concurrency * 2)
+        for name, message, records, error in results:
+            if error is None:
+                writer.write(records)
+                print(label + message)
+            else:
+                failures.append(label + name)
+                print(label + "Export failed for " + name + ": " + error)
+
+    return dir, failures
+
+
+class DirectoryExportWriter:
+    """Export writer that writes every destination and bindings set to its own json file, named by prefix, in the export dir.
+    Files are independent, so records are written by the export workers"""
+
+    parallel = True
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, records):
+        for prefix, name, data in records:
+            with open(self.path + '/' + prefix + '_' + name + '.json', 'w') as outfile:
+                outfile.write(json.dumps(data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class BundleExportWriter:
+    """Export writer that streams a header and then every destination and bindings set as typed, gzip compressed, NDJSON records
+    of a single bundle file. Records are written in listing order"""
+
+    parallel = False
+
+    def __init__(self, path, target):
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.file.write(json.dumps({"type": "header", "format": BUNDLE_FORMAT, "version": BUNDLE_VERSION,
+            "exportedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "target": target}) + '\n')
+
+    def write(self, records):
+        for prefix, name, data in records:
+            self.file.write(json.dumps({"type": prefix, "name": name, "data": data}) + '\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+        return False
+
+
+def exportDestination_util(client, writer, value):
+    """This function fetches the bindings of an exchange and returns the exportRecords_util result, or the exchange id and error when the bindings request fails"""
+
+    bindings = None
+    if value.get('type') != 'queue':
+
+        #### Request bindings to AMQ Rest API ####
+
+        try:
+            bindings = fetchBindings_util(client, value.get('exchangeId'))
+        except Exception as err:
+            return value.get('exchangeId'), None, [], str(err)
+
+    return exportRecords_util(writer, value, bindings)
+
+
+async def exportDestinationAsync_util(client, writer, value):
+    """Async twin of exportDestination_util"""
+
+    bindings = None
+    if value.get('type') != 'queue':
+        try:
+            bindings = await fetchBindings_util(client, value.get('exchangeId'))
+        except Exception as err:
+            return value.get('exchangeId'), None, [], str(err)
+
+    # Parallel writers write the files here, off the event loop #
+    return await asyncio.get_running_loop().run_in_executor(None, exportRecords_util, writer, value, bindings)
+
+
+def exportRecords_util(writer, value, bindings):
+    """This function builds the export records of a destination, with the bindings of an exchange, and returns the
+    exportDestination_util result"""
+
+    if(value.get('type') == 'queue' ):
+        queueId = value.get('queueId')
+        if(str(value.get('deadLetterSources')) == 'None'):
+            records = [('queue', queueId, value)]
+        else:
+            records = [('queue-dlq', queueId, value)]
+        name, message = queueId, "Queue extracted: " + queueId
+    else:
+        exchangeId = value.get('exchangeId')
+        records = [('exchange', exchangeId, value), ('bindings', exchangeId, bindings)]
+        name, message = exchangeId, "Exchange with bindings extracted: " + exchangeId
+
+    if writer.parallel:
+        writer.write(records)
+        records = []
+
+    return name, message, records, None
+
+
+def readExport_util(confPath):
+    """This function is a single pass generator over the records of an export, either a directory of json files or a bundle file.
+    It yields (prefix, label, data) tuples, prefix being queue, queue-dlq, exchange or bindings"""
+
+    if os.path.isfile(confPath):
+        with gzip.open(confPath, 'rt', encoding='utf-8') as bundle:
+            header = json.loads(bundle.readline() or '{}')
+            if header.get('format') != BUNDLE_FORMAT or header.get('version', 0) > BUNDLE_VERSION:
+                raise Exception(confPath + ' is not a supported export bundle')
+            for line in bundle:
+                record = json.loads(line)
+                yield record['type'], record['type'] + '_' + record['name'], record['data']
+        return
+
+    for file in sorted(os.listdir(confPath)):
+        if not file.endswith('.json'):
+            continue
+        prefix = file.split('_', 1)[0]
+        if prefix in ('queue', 'queue-dlq', 'exchange', 'bindings'):
+            with open(os.path.join(confPath, file)) as json_file:
+                yield prefix, file, json.load(json_file)
+
+
+def loadImportGraph_util(confPath):
+    """This function reads an export (directory or bundle) and returns its items keyed by destination, each one with the keys it depends on"""
+
+    nodes = {}
+    for prefix, file, data in readExport_util(confPath):
+        if prefix in ('queue', 'queue-dlq'):
+            nodes[('queue', data['queueId'])] = {'kind': 'queue', 'file': file, 'item': data, 'deps': []}
+        elif prefix == 'exchange':
+            nodes[('exchange', data['exchangeId'])] = {'kind': 'exchange', 'file': file, 'item': data, 'deps': []}
+        else:
+            for item in data:
+                nodes[('binding', item['exchangeId'], item['queueId'])] = {'kind': 'binding', 'file': file, 'item': item, 'deps': []}
+
+    #### Only dependencies that are part of the export are tracked, the rest are expected to exist already ####
+    for key, node in nodes.items():
+        item = node['item']
+        if node['kind'] == 'queue' and item.get('deadLetterQueueId'):
+            deps = [('queue', item['deadLetterQueueId'])]
+        elif node['kind'] == 'binding':
+            deps = [('exchange', item['exchangeId']), ('queue', item['queueId'])]
+        else:
+            deps = []
+        node['deps'] = [dep for dep in deps if dep in nodes and dep != key]
+
+    return nodes
+
+
+def importWaves_util(nodes):
+    """This function groups the import items (or plan changes) in waves, every item only depends on items of previous waves"""
+
+    waves = []
+    done = set()
+    pending = set(nodes)
+    while pending:
+        wave = sorted(key for key in pending if all(dep in done for dep in nodes[key]['deps']))
+        if not wave:
+            raise Exception('Circular dead letter queue references between: ' + ', '.join(sorted(' '.join(key) for key in pending)))
+        waves.append(wave)
+        done.update(wave)
+        pending.difference_update(wave)
+
+    return waves
+
+
+def importJournalPath(confPath, target):
+    """This function returns the default import journal of a conf path and target, under the cache dir"""
+
+    digest = hashlib.sha256(json.dumps([os.path.abspath(confPath), target], sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir(), 'journals', os.path.basename(confPath.rstrip('/' + os.sep)) + '_' + digest + '.journal.ndjson')
+
+
+class ImportJournal:
+    """Append-only NDJSON journal of the items an import completed or failed, keyed by a hash of the target and of the item content,
+    so an item changed in the export since is imported again. With resume the items journaled as done are skipped.
+    Without resume the journal starts over, unless it records failed items and overwrite is not set"""
+
+    def __init__(self, path, target, resume=False, overwrite=False):
+        self.path = path
+        self.target = target
+        self.completed = set()
+        failed = set()
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue   # Last line cut by a crash #
+                    if entry.get('status') == 'done':
+                        self.completed.add(entry['key'])
+                        failed.discard(entry['key'])
+                    else:
+                        failed.add(entry['key'])
+        if failed and not resume and not overwrite:
+            raise Exception('The journal ' + path + ' records ' + str(len(failed)) + ' failed items. Run the import with --resume to import them, ' +
+                'or with --journal to start a new journal')
+        if not resume:
+            self.completed = set()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a' if resume else 'w')
+
+    def key(self, node):
+        return hashlib.sha256(json.dumps([self.target, node['kind'], node['item']], sort_keys=True).encode()).hexdigest()
+
+    def isDone(self, node):
+        return self.key(node) in self.completed
+
+    def record(self, node, error):
+        self.file.write(json.dumps({"key": self.key(node), "kind": node['kind'], "file": node['file'], "status": "done" if error is None else "failed",
+            "error": error, "ts": round(time.time(), 3)}) + '\n')
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+        return False
+
+
+class ImportProgress:
+    """Prints the import progress, with the rate and ETA of this run, at most every PROGRESS_INTERVAL seconds and when the last item is done"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.start = time.time()
+        self.printed = self.start
+
+    def skip(self, count):
+        self.done += count
+        self.skipped += count
+
+    def step(self):
+        self.done += 1
+        now = time.time()
+        if now - self.printed < PROGRESS_INTERVAL and self.done < self.total:
+            return
+        self.printed = now
+        rate = (self.done - self.skipped) / max(now - self.start, 1e-6)
+        eta = (self.total - self.done) / rate if rate else 0
+        print("Progress: " + str(self.done) + "/" + str(self.total) + " items (" + str(int(100 * self.done / self.total)) + "%), " +
+            str(round(rate, 1)) + " items/s, ETA " + str(round(eta)) + "s", flush=True)
+
+
+def createQueueFromExport_util(client, item):
+    """This function creates a queue from its exported definition"""
+
+    return createQueue_util(client, *queueFromExport_util(item))
+
+
+def queueFromExport_util(item):
+    """This function returns the createQueue_util arguments of an exported queue definition"""
+
+    if(not 'deadLetterQueueId' in item):
+        deadLetterQueueId = ''
+    else:
+        deadLetterQueueId = item['deadLetterQueueId']
+    if(not 'maxDeliveries' in item):
+        maxdeliv = 10
+    else:
+        maxdeliv = item['maxDeliveries']
+
+    return (item['queueId'], item['fifo'], item['defaultTtl'], item['defaultLockTtl'],  item['encrypted'], deadLetterQueueId , maxdeliv , item['defaultDeliveryDelay'])
+
+
+def importItem_util(client, node, failed):
+    """This function creates a queue, exchange or binding read by loadImportGraph_util and returns None, or the error message when it fails or one of its dependencies failed"""
+
+    blocked = [dep for dep in node['deps'] if dep in failed]
+    if blocked:
+        return 'skipped, depends on failed ' + ', '.join(dep[1] for dep in blocked)
+
+    try:
+        result = createImportItem_util(client, node)
+    except Exception as err:
+        return str(err)
+
+    print(json.dumps(result))
+
+    return None
+
+
+def createImportItem_util(client, node):
+    """This function runs the util function creating a queue, exchange or binding read by loadImportGraph_util"""
+
+    item = node['item']
+    if node['kind'] == 'queue':
+        return createQueueFromExport_util(client, item)
+    if node['kind'] == 'exchange':
+        return createExchange_util(client, item['exchangeId'], item['encrypted'])
+    return bindQueues_util(client, item['exchangeId'],  item['queueId'])
+
+
+async def importItemAsync_util(client, node, failed):
+    """Async twin of importItem_util"""
+
+    blocked = [dep for dep in node['deps'] if dep in failed]
+    if blocked:
+        return 'skipped, depends on failed ' + ', '.join(dep[1] for dep in blocked)
+
+    try:
+        result = await createImportItem_util(client, node)
+    except Exception as err:
+        return str(err)
+
+    print(json.dumps(result))
+
+    return None
+
+
+#### Batch operations, keyed by command name. Fields are the command long option names ####
+BATCH_OPERATIONS = {
+    'search': lambda client, op: list(search_util(client)),
+    'find-queue': lambda client, op: findQueue_util(client, op['name']),
+    'find-exchange': lambda client, op: findExchange_util(client, op['name']),
+    'create-queue': lambda client, op: createQueue_util(client, op['name'], op.get('fifo', False), op.get('ttl', 120000), op.get('lock-ttl', 10000), op.get('encrypted', False), op.get('dead-letter-queue'), op.get('max-attempts'), op.get('delivery-delay')),
+    'update-queue': lambda client, op: updateQueue_util(client, op['name'], op.get('fifo', False), op.get('ttl', 120000), op.get('lock-ttl', 10000), op.get('encrypted', False), op.get('dead-letter-queue'), op.get('max-attempts'), op.get('delivery-delay')),
+    'create-exchange': lambda client, op: createExchange_util(client, op['name'], op.get('encrypted', False)),
+    'update-exchange': lambda client, op: updateExchange_util(client, op['name'], op.get('encrypted', False)),
+    'bind-queue': lambda client, op: bindQueues_util(client, op['exchange-name'], op['queue-name']),
+    'unbind-queue': lambda client, op: unbindQueues_util(client, op['exchange-name'], op['queue-name']),
+    'delete-queue': lambda client, op: deleteQueue_util(client, op['name']),
+    'delete-exchange': lambda client, op: deleteExchange_util(client, op['name']),
+    'purge': lambda client, op: purge_util(client, op['name']),
+}
+
+
+def batchOperation_util(client, number, line):
+    """This function executes one NDJSON batch operation and returns its result line, with the error of an invalid or failed operation"""
+
+    op = None
+    try:
+        op = json.loads(line)
+        if op.get('op') not in BATCH_OPERATIONS:
+            raise Exception('Unknown operation: ' + str(op.get('op')))
+        result = BATCH_OPERATIONS[op['op']](client, op)
+    except KeyError as err:
+        return {"line": number, "op": op.get('op'), "success": False, "error": 'Missing field: ' + str(err)}
+    except Exception as err:
+        return {"line": number, "op": op.get('op') if isinstance(op, dict) else None, "success": False, "error": str(err)}
+
+    return {"line": number, "op": op['op'], "success": True, "result": result}
+
+
+#### Fields that can be changed on an existing destination, compared by plan ####
+QUEUE_PATCH_FIELDS = ('defaultTtl', 'defaultLockTtl', 'encrypted', 'deadLetterQueueId', 'maxDeliveries', 'defaultDeliveryDelay')
+EXCHANGE_PATCH_FIELDS = ('encrypted',)
+
+
+def fetchBindings_util(client, exchangeId):
+    """This function returns the bindings of an exchange"""
+
+    return client.send({"method": "GET", "path": '/bindings/exchanges/' + exchangeId})
+
+
+def fetchAllBindings_util(client, exchangeIds, concurrency, backend='threads'):
+    """This function returns the bindings of every exchange, in exchangeIds order, fetched by <concurrency> workers or requests in flight"""
+
+    with bulkExecutor_util(client, backend, concurrency) as executor:
+        if backend == 'async':
+            return list(executor.map(fetchBindings_util, exchangeIds))
+        return list(executor.map(lambda exchangeId: fetchBindings_util(client, exchangeId), exchangeIds))
+
+
+def loadLiveState_util(client, concurrency, backend='threads'):
+    """This function returns the live queues, exchanges and bindings, with one destinations listing and one bindings request per exchange"""
+
+    queues = {}
+    exchanges = {}
+    for value in listDestinations_util(client, noCache=True):
+        if value.get('type') == 'queue':
+            queues[value['queueId']] = value
+        elif value.get('type') == 'exchange':
+            exchanges[value['exchangeId']] = value
+
+    bindings = set()
+    for exchangeBindings in fetchAllBindings_util(client, sorted(exchanges), concurrency, backend):
+        bindings.update((item['exchangeId'], item['queueId']) for item in exchangeBindings)
+
+    return queues, exchanges, bindings
+
+
+def planChanges_util(client, confPath, prune=False, concurrency=1, backend='threads'):
+    """This function compares the exported conf files with the live state and returns the minimal list of changes"""
+
+    desired = loadImportGraph_util(confPath)
+    desiredQueues = {key[1]: node['item'] for key, node in desired.items() if node['kind'] == 'queue'}
+    desiredExchanges = {key[1]: node['item'] for key, node in desired.items() if node['kind'] == 'exchange'}
+    desiredBindings = set(key[1:] for key, node in desired.items() if node['kind'] == 'binding')
+
+    liveQueues, liveExchanges, liveBindings = loadLiveState_util(client, concurrency, backend)
+
+    changes = []
+    for kind, desiredItems, liveItems, fields in (('queue', desiredQueues, liveQueues, QUEUE_PATCH_FIELDS), ('exchange', desiredExchanges, liveExchanges, EXCHANGE_PATCH_FIELDS)):
+        for name in sorted(desiredItems):
+            item = desiredItems[name]
+            if name not in liveItems:
+                changes.append({"action": "create-" + kind, "name": name, "item": item})
+                continue
+            payload = {field: item.get(field) for field in fields if (field in item or field in liveItems[name]) and item.get(field) != liveItems[name].get(field)}
+            if payload:
+                changes.append({"action": "patch-" + kind, "name": name, "payload": payload})
+
+    for exchangeId, queueId in sorted(desiredBindings - liveBindings):
+        changes.append({"action": "bind", "exchange": exchangeId, "queue": queueId})
+
+    #### Bindings of exchanges that are not in the conf files are only removed with --prune, before the exchange is deleted ####
+    for exchangeId, queueId in sorted(liveBindings - desiredBindings):
+        if exchangeId in desiredExchanges or prune:
+            changes.append({"action": "unbind", "exchange": exchangeId, "queue": queueId})
+
+    if prune:
+        for name in sorted(set(liveExchanges) - set(desiredExchanges)):
+            changes.append({"action": "delete-exchange", "name": name})
+        for name in sorted(set(liveQueues) - set(desiredQueues)):
+            changes.append({"action": "delete-queue", "name": name, "deadLetterQueueId": liveQueues[name].get('deadLetterQueueId')})
+
+    return changePlan_util(client, changes)
+
+
+def changePlan_util(client, changes):
+    """This function returns the plan of the given changes, as printed by plan and read by apply --plan"""
+
+    summary = {}
+    for change in changes:
+        summary[change['action']] = summary.get(change['action'], 0) + 1
+
+    return {
+        "target": {"region": client.region, "organizationId": client.orgId, "environmentId": client.envId},
+        "summary": summary,
+        "changes": changes
+    }
+
+
+def applyChanges_util(client, changes, concurrency, start, backend='threads'):
+    """This function runs plan changes with up to <concurrency> workers (or requests in flight with the async backend), printing one JSON line
+    per change and a summary, and raises when a change failed"""
+
+    #### Changes run in waves, so DLQs exist before their queues, destinations before their bindings and bindings are removed before deletions ####
+    nodes = planGraph_util(changes)
+    waves = importWaves_util(nodes)
+
+    failed = set()
+    with client.index.deferred(), bulkExecutor_util(client, backend, concurrency) as executor:
+        for wave in waves:
+            if backend == 'async':
+                results = executor.map(lambda aclient, key: applyChangeAsync_util(aclient, nodes[key], failed), wave)
+            else:
+                results = executor.map(lambda key: applyChange_util(client, nodes[key], failed), wave)
+            for key, result in zip(wave, results):
+                if not result['success']:
+                    failed.add(key)
+                print(json.dumps(result), flush=True)
+
+    print(json.dumps({
+        "changes": len(nodes),
+        "failed": len(failed),
+        "elapsedSeconds": round(time.time() - start, 2)
+    }))
+
+    if failed:
+        raise Exception(str(len(failed)) + ' of ' + str(len(nodes)) + ' changes failed')
+
+
+def matchDestinations_util(client, kind, patterns, regex=False):
+    """This function returns the queues or exchanges whose name matches any of the glob (or, with regex, regular expression) patterns,
+    keyed by name, from a fresh destinations listing, and the unmatched queues using each dead letter queue"""
+
+    expressions = [re.compile(pattern if regex else fnmatch.translate(pattern)) for pattern in patterns]
+    idKey = 'queueId' if kind == 'queue' else 'exchangeId'
+    matched = {}
+    deadLetterUsers = {}
+    for value in listDestinations_util(client, noCache=True):
+        if value.get('type') != kind:
+            continue
+        if any(expression.fullmatch(value[idKey]) for expression in expressions):
+            matched[value[idKey]] = value
+        elif value.get('deadLetterQueueId'):
+            deadLetterUsers.setdefault(value['deadLetterQueueId'], []).append(value[idKey])
+
+    return matched, deadLetterUsers
+
+
+def bulkChanges_util(client, action, patterns, regex, dryRun, concurrency, backend='threads'):
+    """This function runs delete-queue, delete-exchange or purge on every destination matching the patterns, as plan changes:
+    exchanges are unbound from their queues before being deleted and dead letter queues are deleted after the queues using them.
+    A dead letter queue still used by a queue that is not deleted is skipped with a warning. With dryRun the plan is printed instead"""
+
+    start = time.time()
+    matched, deadLetterUsers = matchDestinations_util(client, 'exchange' if action == 'delete-exchange' else 'queue', patterns, regex)
+    names = sorted(matched)
+
+    changes = []
+    if action == 'delete-exchange':
+        for exchangeId, exchangeBindings in zip(names, fetchAllBindings_util(client, names, concurrency, backend)):
+            changes.extend({"action": "unbind", "exchange": exchangeId, "queue": item['queueId']} for item in exchangeBindings)
+    for name in names:
+        if action == 'delete-queue' and name in deadLetterUsers:
+            click.echo('Skipped ' + name + ': dead letter queue of ' + ', '.join(sorted(deadLetterUsers[name])) + ', not matched', err=True)
+        elif action == 'delete-queue':
+            changes.append({"action": action, "name": name, "deadLetterQueueId": matched[name].get('deadLetterQueueId')})
+        else:
+            changes.append({"action": action, "name": name})
+
+    if dryRun:
+        print(json.dumps(changePlan_util(client, changes)))
+    else:
+        applyChanges_util(client, changes, concurrency, start, backend)
+
+
+def planChangeKey(change):
+    """This function returns the graph key of a plan change"""
+    if change['action'] in ('bind', 'unbind'):
+        return (change['action'], change['exchange'], change['queue'])
+    return (change['action'], change['name'])
+
+
+def planGraph_util(changes):
+    """This function returns the plan changes keyed by planChangeKey, each one with the keys it depends on"""
+
+    nodes = {planChangeKey(change): {'kind': change['action'], 'change': change, 'deps': []} for change in changes}
+
+    for key, node in nodes.items():
+        change = node['change']
+        action = change['action']
+        if action == 'create-queue' and change['item'].get('deadLetterQueueId'):
+            deps = [('create-queue', change['item']['deadLetterQueueId'])]
+        elif action == 'patch-queue' and change['payload'].get('deadLetterQueueId'):
+            deps = [('create-queue', change['payload']['deadLetterQueueId'])]
+        elif action == 'bind':
+            deps = [('create-exchange', change['exchange']), ('create-queue', change['queue'])]
+        elif action == 'delete-exchange':
+            deps = [other for other in nodes if other[0] == 'unbind' and other[1] == change['name']]
+        elif action == 'delete-queue':
+            # A DLQ is deleted after the queues that use it #
+            deps = [other for other in nodes if other[0] == 'unbind' and other[2] == change['name']] + \
+                [other for other in nodes if other[0] == 'delete-queue' and nodes[other]['change'].get('deadLetterQueueId') == change['name']]
+        else:
+            deps = []
+        node['deps'] = [dep for dep in deps if dep in nodes and dep != key]
+
+    return nodes
+
+
+def applyChange_util(client, node, failed):
+    """This function runs a plan change, unless one of its dependencies failed, and returns its result with the success flag and message"""
+
+    result = changeResult_util(node, failed)
+    if 'success' in result:
+        return result
+
+    try:
+        return dict(result, **runChange_util(client, node['change']))
+    except Exception as err:
+        return dict(result, success=False, message=str(err))
+
+
+def changeResult_util(node, failed):
+    """This function returns the result fields naming a plan change, already failed when one of its dependencies failed"""
+
+    change = node['change']
+    result = {"action": change['action']}
+    result.update({field: change[field] for field in ('name', 'exchange', 'queue') if field in change})
+
+    blocked = [dep for dep in node['deps'] if dep in failed]
+    if blocked:
+        result.update(success=False, message='skipped, depends on failed ' + ', '.join(' '.join(dep) for dep in blocked))
+
+    return result
+
+
+def runChange_util(client, change):
+    """This function runs the util function of a plan change"""
+
+    action = change['action']
+    if action == 'create-queue':
+        return createQueueFromExport_util(client, change['item'])
+    elif action == 'create-exchange':
+        return createExchange_util(client, change['item']['exchangeId'], change['item']['encrypted'])
+    elif action == 'patch-queue':
+        return patchDestination_util(client, 'queue', change['name'], change['payload'])
+    elif action == 'patch-exchange':
+        return patchDestination_util(client, 'exchange', change['name'], change['payload'])
+    elif action == 'bind':
+        return bindQueues_util(client, change['exchange'], change['queue'])
+    elif action == 'unbind':
+        return unbindQueues_util(client, change['exchange'], change['queue'])
+    elif action == 'delete-exchange':
+        return deleteExchange_util(client, change['name'])
+    elif action == 'delete-queue':
+        return deleteQueue_util(client, change['name'])
+    elif action == 'purge':
+        return purge_util(client, change['name'])
+    raise Exception('Unknown plan action: ' + action)
+
+
+async def applyChangeAsync_util(client, node, failed):
+    """Async twin of applyChange_util"""
+
+    result = changeResult_util(node, failed)
+    if 'success' in result:
+        return result
+
+    try:
+        return dict(result, **await runChange_util(client, node['change']))
+    except Exception as err:
+        return dict(result, success=False, message=str(err))
+
+
+def patchDestination_util(client, kind, name, payload):
+    """This function patches only the given fields of a queue or an exchange"""
+
+    return client.send({"method": "PATCH", "path": '/destinations/' + kind + 's/' + name, "payload": payload, "index": (kind, name, payload),
+        "message": name + " was successfully updated"})
+
+def destinationStats_util(client, kind, name, window):
+    """This function returns the stats of a queue or exchange over the last <window> seconds: the latest depth and in flight messages
+    of a queue and the totals of its counters"""
+
+    end = time.time()
+    params = {"startDate": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(end - window)),
+        "endDate": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(end)), "period": window}
+
+    try:
+        values = client.stats('/' + kind + 's/' + name, params).json()
+    except HTTPError as http_err:
+        raise Exception('HTTP error occurred: ' + str(http_err))
+    except Exception as err:
+        raise Exception('Other error occurred: ' + str(err))
+
+    # Every stat is a list of {"date", "value"} points, one per period #
+    def latest(key):
+        points = values.get(key) or []
+        return points[-1]['value'] if points else 0
+
+    def total(key):
+        return sum(point['value'] for point in values.get(key) or [])
+
+    if kind == 'queue':
+        return {"type": kind, "name": name, "depth": latest('messagesVisible'), "inFlight": latest('messagesInFlight'),
+            "sent": total('messagesSent'), "received": total('messagesReceived'), "acked": total('messagesAcked')}
+    return {"type": kind, "name": name, "published": total('messagesPublished'), "delivered": total('messagesDelivered')}
+
+
+def statsSnapshot_util(client, kind, window, concurrency, noCache=False, refresh=False):
+    """This function returns the stats of every queue and exchange (or only those of kind), fetched with up to <concurrency> workers.
+    The rows of destinations whose stats could not be fetched have an error field instead. The snapshot is saved without them
+    and answers the same region, environment, kind and window for MQ_STATS_TTL seconds, fetching again only the failed ones"""
+
+    ttl = float(os.environ.get('MQ_STATS_TTL', STATS_DEFAULT_TTL))
+    path = os.path.join(cacheDir(), 'stats', client.orgId + '_' + client.envId + '_' + client.region + '_' + str(window) + ('' if kind == 'all' else '_' + kind) + '.json')
+    snapshot = None
+    if ttl > 0 and not noCache and not refresh:
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if time.time() - snapshot['fetchedAt'] >= ttl:
+                snapshot = None
+        except (OSError, ValueError, KeyError):
+            snapshot = None
+
+    if snapshot is not None:
+        rows, targets = snapshot['stats'], [tuple(target) for target in snapshot.get('failed', [])]
+        if not targets:
+            return rows
+    else:
+        snapshot = {'fetchedAt': time.time()}
+        rows = []
+        targets = [(value['type'], value.get('queueId') or value.get('exchangeId')) for value in listDestinations_util(client, noCache, refresh)
+            if kind == 'all' or value['type'] == kind]
+
+    def fetch(target):
+        try:
+            return destinationStats_util(client, target[0], target[1], window)
+        except Exception as err:
+            return {"type": target[0], "name": target[1], "error": str(err)}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        fetched = list(executor.map(fetch, targets))
+    rows = rows + [row for row in fetched if 'error' not in row]
+    failures = [row for row in fetched if 'error' in row]
+
+    if ttl > 0 and not noCache:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpPath, 'w') as snapshot_file:
+            json.dump({'fetchedAt': snapshot['fetchedAt'], 'stats': rows, 'failed': [[row['type'], row['name']] for row in failures]}, snapshot_file)
+        os.replace(tmpPath, path)
+
+    return rows + failures
+
+
+def sortStats_util(rows, field):
+    """This function sorts stats rows by name or type, or by a counter in descending order with the rows without it last"""
+
+    if field in ('name', 'type'):
+        return sorted(rows, key=lambda row: (row[field], row['name']))
+    return sorted(rows, key=lambda row: (field not in row, -row.get(field, 0), row['name']))
+
+
+def printStats_util(rows, format):
+    """This function prints stats rows as aligned table columns, NDJSON or CSV. Fields no row has are left out of the table and CSV,
+    the error of the rows that failed comes last"""
+
+    if format == 'ndjson':
+        for row in rows:
+            print(json.dumps(row))
+        return
+
+    fields = [field for field in STATS_FIELDS + ['error'] if any(field in row for row in rows)] or STATS_FIELDS[:2]
+    if format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+        return
+
+    cells = [fields] + [[str(row.get(field, '')) for field in fields] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(fields))]
+    for line in cells:
+        print('  '.join(cell.ljust(width) if i < 2 else cell.rjust(width) for i, (cell, width) in enumerate(zip(line, widths))).rstrip())
+
+
+class DestinationsWatcher:
+    """In-memory snapshot of the destinations, and optionally the bindings, of a region, org id and environment id.
+    Every poll revalidates the listing (and every exchange bindings) with its ETag and returns the differences with the previous poll as events"""
+
+    def __init__(self, client, bindings=False, concurrency=1):
+        self.client = client
+        self.watchBindings = bindings
+        self.concurrency = concurrency
+        self.destinations = {}
+        self.bindings = {}
+        self.etags = {}
+
+    def fetch(self, path):
+        """Returns the response of a conditional GET, None when the resource did not change since the last poll"""
+
+        headers = dict(self.client.headers)
+        if path in self.etags:
+            headers['If-None-Match'] = self.etags[path]
+        response = httpRequest("GET", self.client.baseUrl + path, headers=headers, stream=True)
+        if response.status_code == 304:
+            response.close()
+            return None
+        self.etags[path] = response.headers.get('ETag')
+        if self.etags[path] is None:
+            del self.etags[path]
+        return response
+
+    def fetchBindings(self, exchangeId):
+        try:
+            response = self.fetch('/bindings/exchanges/' + exchangeId)
+        except HTTPError as http_err:
+            # Deleted since the listing #
+            if http_err.response is not None and http_err.response.status_code == 404:
+                return set()
+            raise
+        return self.bindings.get(exchangeId, set()) if response is None else set(item['queueId'] for item in iterJsonArray_util(response))
+
+    def poll(self):
+        """Returns the added, removed and modified events since the last poll, every destination is added on the first one"""
+
+        try:
+            response = self.fetch('/destinations')
+        except HTTPError as http_err:
+            raise Exception('HTTP error occurred: ' + str(http_err))
+
+        destinations = self.destinations
+        if response is not None:
+            destinations = {(value['type'], value.get('queueId') or value.get('exchangeId')): value for value in iterJsonArray_util(response)}
+
+        events = []
+        for key in sorted(destinations.keys() | self.destinations.keys()):
+            before, after = self.destinations.get(key), destinations.get(key)
+            if before is None:
+                events.append({"event": "added", "type": key[0], "name": key[1], "destination": after})
+            elif after is None:
+                events.append({"event": "removed", "type": key[0], "name": key[1]})
+            elif before != after:
+                events.append({"event": "modified", "type": key[0], "name": key[1],
+                    "changes": {field: [before.get(field), after.get(field)] for field in sorted(before.keys() | after.keys()) if before.get(field) != after.get(field)}})
+        self.destinations = destinations
+
+        if self.watchBindings:
+            exchanges = sorted(name for kind, name in destinations if kind == 'exchange')
+            for exchangeId in list(self.bindings):
+                if exchangeId not in exchanges:
+                    self.etags.pop('/bindings/exchanges/' + exchangeId, None)
+            try:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    bindings = dict(zip(exchanges, executor.map(self.fetchBindings, exchanges)))
+            except HTTPError as http_err:
+                raise Exception('HTTP error occurred: ' + str(http_err))
+
+            # The bindings of a removed exchange go with its removed event #
+            for exchangeId in exchanges:
+                before, after = self.bindings.get(exchangeId, set()), bindings[exchangeId]
+                events.extend({"event": "added", "type": "binding", "exchange": exchangeId, "queue": queueId} for queueId in sorted(after - before))
+                events.extend({"event": "removed", "type": "binding", "exchange": exchangeId, "queue": queueId} for queueId in sorted(before - after))
+            self.bindings = bindings
+
+        return events
+
+
+def watch_util(watcher, token, interval, maxInterval, initial=False, duration=None):
+    """This function polls the watcher and prints its events as NDJSON lines, stamped with the poll time. The wait between polls starts at
+    <interval> seconds and doubles after every poll without events (or failed) up to <maxInterval>. It runs for <duration> seconds, forever by default"""
+
+    deadline = time.time() + duration if duration is not None else None
+    wait = interval
+    first = True
+    while True:
+        watcher.client.headers['Authorization'] = 'bearer ' + token()
+        try:
+            events = watcher.poll()
+        except Exception as err:
+            events = None
+            click.echo(json.dumps({"event": "error", "message": str(err), "ts": round(time.time(), 3)}), err=True)
+
+        if first and events is not None:
+            first = False
+            if not initial:
+                events = []
+
+        ts = round(time.time(), 3)
+        for event in events or []:
+            print(json.dumps(dict(event, ts=ts)))
+        sys.stdout.flush()
+
+        wait = interval if events else min(wait * 2, maxInterval)
+        if deadline is not None and time.time() + wait > deadline:
+            return
+        time.sleep(wait)
+
+
+#### Broker API: messages ####
+
+class ThroughputProgress:
+    """Prints to stderr how many messages were processed and the successful messages per second, at most every PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self.printed = self.start
+
+    def rate(self):
+        return (self.done - self.failed) / max(time.time() - self.start, 1e-6)
+
+    def step(self, done, failed=0):
+        self.done += done
+        self.failed += failed
+        now = time.time()
+        if now - self.printed < PROGRESS_INTERVAL:
+            return
+        self.printed = now
+        click.echo(self.verb + ": " + str(self.done) + " messages (" + str(self.failed) + " failed), " + str(round(self.rate(), 1)) + " messages/s", err=True)
+
+    def summary(self):
+        return {
+            self.verb.lower(): self.done - self.failed,
+            "failed": self.failed,
+            "elapsedSeconds": round(time.time() - self.start, 2),
+            "messagesPerSecond": round(self.rate(), 1)
+        }
+
+
+def chunks_util(items, size):
+    """This function yields lists of up to <size> consecutive items, consuming items lazily"""
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def messageFromLine_util(line):
+    """This function returns the broker API message of an NDJSON line. A line without a body field is the body itself,
+    a body that is not a string is sent as JSON and a missing messageId is generated"""
+
+    value = json.loads(line)
+    if not isinstance(value, dict) or 'body' not in value:
+        value = {"body": value}
+    body = value['body'] if isinstance(value['body'], str) else json.dumps(value['body'])
+    message = {"messageId": str(value.get('messageId') or uuid.uuid4()), "body": body}
+    if value.get('properties'):
+        message['properties'] = value['properties']
+    return message
+
+
+def publishBatch_util(broker, destination, batch):
+    """This function publishes a batch of (line number, NDJSON line) with a single broker API request and returns one result per line, invalid lines included"""
+
+    results = []
+    messages = []
+    for number, line in batch:
+        try:
+            message = messageFromLine_util(line)
+        except ValueError as err:
+            results.append({"line": number, "success": False, "message": 'Invalid message: ' + str(err)})
+            continue
+        messages.append(message)
+        results.append({"line": number, "messageId": message['messageId'], "success": True})
+
+    if messages:
+        failures = publishMessages_util(broker, destination, messages)
+        for result in results:
+            if result['success'] and result['messageId'] in failures:
+                result.update(success=False, message=failures[result['messageId']])
+
+    return results
+
+
+def publishMessages_util(broker, destination, messages):
+    """This function publishes broker API messages with a single request and returns the ids of those that failed, with their error"""
+
+    try:
+        statuses = broker.request("PUT", '/destinations/' + destination + '/messages', messages).json()
+    except HTTPError as http_err:
+        return {message['messageId']: 'HTTP error occurred: ' + str(http_err) for message in messages}
+    except Exception as err:
+        return {message['messageId']: 'Other error occurred: ' + str(err) for message in messages}
+
+    # The broker API answers one status per message #
+    return {status.get('messageId'): status.get('statusMessage') or status.get('status') for status in statuses or [] if status.get('status') != 'successful'}
+
+
+def publishLines_util(broker, destination, lines, batchSize, concurrency):
+    """This function publishes the NDJSON lines as messages, in batches of <batchSize> with up to <concurrency> batch requests in flight.
+    Lines are read as batches are sent, so a large file or stdin is never loaded at once. Failed messages are printed as JSON lines"""
+
+    progress = ThroughputProgress('Published')
+    numbered = ((number, line) for number, line in enumerate(lines, start=1) if line.strip())
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for results in boundedMap_util(executor, lambda batch: publishBatch_util(broker, destination, batch), chunks_util(numbered, batchSize), concurrency * 2):
+            failures = [result for result in results if not result['success']]
+            for result in failures:
+                print(json.dumps(result), flush=True)
+            progress.step(len(results), len(failures))
+
+    summary = progress.summary()
+    print(json.dumps(dict(summary, destination=destination)))
+
+    if summary['failed']:
+        raise Exception(str(summary['failed']) + ' of ' + str(progress.done) + ' messages failed')
+
+def pullMessages_util(broker, queue, batchSize, lockTtl=None, poll=0):
+    """This function pulls and locks up to <batchSize> messages of a queue. Without lockTtl the queue defaultLockTtl applies"""
+
+    params = {"batchSize": batchSize, "poll": poll}
+    if lockTtl is not None:
+        params['lockTtl'] = lockTtl
+
+    try:
+        return broker.request("GET", '/destinations/' + queue + '/messages', params=params).json() or []
+    except HTTPError as http_err:
+        raise Exception('HTTP error occurred: ' + str(http_err))
+    except Exception as err:
+        raise Exception('Other error occurred: ' + str(err))
+
+
+def ackMessages_util(broker, queue, messages):
+    """This function acknowledges (deletes) pulled messages with a single request and returns the ids of those that failed, with their error"""
+
+    locks = [{"messageId": message['headers']['messageId'], "lockId": message['headers']['lockId']} for message in messages]
+    try:
+        statuses = broker.request("DELETE", '/destinations/' + queue + '/messages', locks).json()
+    except HTTPError as http_err:
+        return {lock['messageId']: 'HTTP error occurred: ' + str(http_err) for lock in locks}
+    except Exception as err:
+        return {lock['messageId']: 'Other error occurred: ' + str(err) for lock in locks}
+
+    return {status.get('messageId'): status.get('statusMessage') or status.get('status') for status in statuses or [] if status.get('status') != 'successful'}
+
+
+def releaseMessages_util(broker, queue, messages):
+    """This function releases the locks of pulled messages, one request per message, so they are redelivered right away.
+    It returns the ids of those that failed, with their error"""
+
+    failures = {}
+    for message in messages:
+        headers = message['headers']
+        try:
+            broker.request("PUT", '/destinations/' + queue + '/messages/' + headers['messageId'] + '/locks/' + headers['lockId'], {"remainingTtl": 0})
+        except HTTPError as http_err:
+            failures[headers['messageId']] = 'HTTP error occurred: ' + str(http_err)
+        except Exception as err:
+            failures[headers['messageId']] = 'Other error occurred: ' + str(err)
+
+    return failures
+
+
+def messageRecord_util(message):
+    """This function returns the NDJSON record of a pulled message, in the format read by publish"""
+
+    headers = {name: value for name, value in message.get('headers', {}).items() if name != 'lockId'}
+    return {"messageId": headers.get('messageId'), "body": message.get('body'), "properties": message.get('properties', {}), "headers": headers}
+
+
+def drainQueue_util(broker, queue, progress, prefetch, batchSize, lockTtl, poll, maxMessages, timeout, concurrency, settle, write=None, stopOnFailure=False):
+    """This function pulls messages with ceil(prefetch / batchSize) pulls in flight. Every batch is passed to write, in pull order,
+    then to settle on up to <concurrency> workers while the next batches are pulled. settle returns the ids of the messages it failed, with their error.
+    It stops when a pull comes back empty, after <maxMessages>, after <timeout> seconds or, with stopOnFailure, once settle failed.
+    Messages pulled beyond maxMessages are released. It returns the number of messages taken"""
+
+    deadline = time.time() + timeout if timeout is not None else None
+    taken = 0
+    drained = False
+
+    def settled(entry):
+        count, future = entry
+        failures = future.result()
+        for messageId, error in failures.items():
+            click.echo(json.dumps({"messageId": messageId, "success": False, "message": error}), err=True)
+        progress.step(count, len(failures))
+
+    pullers = -(-prefetch // batchSize)
+    with ThreadPoolExecutor(max_workers=pullers) as pulls, ThreadPoolExecutor(max_workers=concurrency) as settlers:
+        pending = deque(pulls.submit(pullMessages_util, broker, queue, batchSize, lockTtl, poll) for _ in range(pullers))
+        settling = deque()
+        while pending:
+            messages = pending.popleft().result()
+            drained = drained or not messages
+            kept = messages[:maxMessages - taken] if maxMessages is not None else messages
+            if len(kept) < len(messages):
+                settlers.submit(releaseMessages_util, broker, queue, messages[len(kept):])
+
+            if kept:
+                if write is not None:
+                    write(kept)
+                taken += len(kept)
+                settling.append((len(kept), settlers.submit(settle, kept)))
+
+            while settling and settling[0][1].done():
+                settled(settling.popleft())
+
+            limited = (maxMessages is not None and taken >= maxMessages) or (deadline is not None and time.time() >= deadline)
+            if not drained and not limited and not (stopOnFailure and progress.failed):
+                pending.append(pulls.submit(pullMessages_util, broker, queue, batchSize, lockTtl, poll))
+
+        while settling:
+            settled(settling.popleft())
+
+    return taken
+
+
+def consumeMessages_util(broker, queue, out, prefetch, batchSize, lockTtl, poll, maxMessages, timeout, nack, concurrency):
+    """This function drains a queue to out, see drainQueue_util: every batch is written and then acknowledged, or released with nack"""
+
+    progress = ThroughputProgress('Consumed')
+    settle = releaseMessages_util if nack else ackMessages_util
+
+    # Written (and flushed) before the ack, a crash redelivers the batch instead of losing it #
+    def write(messages):
+        out.write(''.join(json.dumps(messageRecord_util(message)) + '\n' for message in messages))
+        out.flush()
+
+    written = drainQueue_util(broker, queue, progress, prefetch, batchSize, lockTtl, poll, maxMessages, timeout, concurrency,
+        lambda messages: settle(broker, queue, messages), write)
+
+    summary = progress.summary()
+    click.echo(json.dumps(dict(summary, destination=queue, written=written, acknowledged=not nack)), err=True)
+
+    if summary['failed']:
+        raise Exception(str(summary['failed']) + ' of ' + str(written) + ' messages could not be ' + ('released' if nack else 'acknowledged') + ', they will be redelivered')
+
+
+def redriveSource_util(client, dlq):
+    """This function returns the queue a dead letter queue receives messages from, its only deadLetterSources entry"""
+
+    try:
+        sources = client.request("GET", '/destinations/queues/' + dlq).json().get('deadLetterSources') or []
+    except HTTPError as http_err:
+        raise Exception('HTTP error occurred: ' + str(http_err))
+
+    if len(sources) != 1:
+        raise click.UsageError(dlq + (' is the dead letter queue of ' + ', '.join(sources) + ', choose one with --source' if sources else ' is not the dead letter queue of any queue, use --source'))
+    return sources[0]
+
+
+class RedriveCursor:
+    """Append-only NDJSON file of the message ids a redrive published to the source queue. A message published but not acknowledged
+    before a crash is redelivered by the DLQ: with resume it is only acknowledged, instead of being published twice"""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.moved = set()
+        if resume and os.path.exists(path):
+            with open(path) as cursor:
+                for line in cursor:
+                    try:
+                        self.moved.add(json.loads(line)['messageId'])
+                    except (ValueError, KeyError):
+                        continue   # Last line cut by a crash #
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a' if resume else 'w')
+        self.lock = threading.Lock()
+
+    def isMoved(self, messageId):
+        return messageId in self.moved
+
+    def record(self, messageIds):
+        with self.lock:
+            self.file.write(''.join(json.dumps({"messageId": messageId, "ts": round(time.time(), 3)}) + '\n' for messageId in messageIds))
+            self.file.flush()
+            self.moved.update(messageIds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+        return False
+
+
+def redriveBatch_util(broker, dlq, source, messages, cursor, limiter):
+    """This function publishes a batch of DLQ messages to the source queue, records them in the cursor and acknowledges them in the DLQ.
+    It returns the ids of the failed messages, with their error. Those stay locked in the DLQ until their lock expires, so this run does not pull them again"""
+
+    pending = [message for message in messages if not cursor.isMoved(message['headers']['messageId'])]
+    if limiter is not None:
+        for message in pending:
+            limiter.acquire()
+
+    records = [messageRecord_util(message) for message in pending]
+    failures = publishMessages_util(broker, source, [{field: record[field] for field in ('messageId', 'body', 'properties')} for record in records]) if records else {}
+    cursor.record([record['messageId'] for record in records if record['messageId'] not in failures])
+
+    moved = [message for message in messages if message['headers']['messageId'] not in failures]
+    if moved:
+        failures.update(ackMessages_util(broker, dlq, moved))
+
+    return failures
+
+
+def redrive_util(broker, dlq, source, cursor, prefetch, batchSize, lockTtl, rate, maxMessages, timeout, concurrency):
+    """This function moves the messages of a DLQ to its source queue, see drainQueue_util and redriveBatch_util.
+    It stops pulling at the first failed message and raises once the batches in flight are done"""
+
+    progress = ThroughputProgress('Redriven')
+    limiter = RateLimiter(rate, batchSize) if rate else None
+
+    taken = drainQueue_util(broker, dlq, progress, prefetch, batchSize, lockTtl, 0, maxMessages, timeout, concurrency,
+        lambda messages: redriveBatch_util(broker, dlq, source, messages, cursor, limiter), stopOnFailure=True)
+
+    summary = progress.summary()
+    print(json.dumps(dict(summary, deadLetterQueue=dlq, source=source)))
+
+    if summary['failed']:
+        raise Exception(str(summary['failed']) + ' of ' + str(taken) + ' messages were not moved, run it again with --resume')
 
 ###### UTILS #####
@@ -8,6 +8,9 @@ setup(
     install_requires=[
         'Click', 'Requests', 'jsonlib-python3', 'pymemcache', 'python-memcached'
     ],
+    extras_require={
+        'async': ['httpx']
+    },
     entry_points='''
         [console_scripts]
         mq=mq:cli
@@ -0,0 +1,463 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import types
+
+import pytest
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mq
+
+
+def test_rate_limiter_burst_after_idle():
+    limiter = mq.RateLimiter(10, 5)
+
+    delays = [limiter.reserve() for _ in range(5)]
+    assert delays == [0] * 5
+    assert limiter.reserve() > 0.05
+
+
+def test_rate_limiter_spaces_requests_past_burst():
+    limiter = mq.RateLimiter(10, 1)
+
+    assert limiter.reserve() == 0
+    second = limiter.reserve()
+    third = limiter.reserve()
+    assert 0.05 < second <= 0.1
+    assert 0.15 < third <= 0.2
+
+
+def test_rate_limiter_unlimited():
+    limiter = mq.RateLimiter(0, 10)
+
+    assert [limiter.reserve() for _ in range(100)] == [0] * 100
+
+
+class ChunkedResponse:
+    """Stands for a streamed requests response, its body is returned <size> bytes at a time"""
+
+    encoding = 'utf-8'
+
+    def __init__(self, body, size):
+        self.body = body.encode()
+        self.size = size
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), self.size):
+            yield self.body[start:start + self.size]
+
+    def close(self):
+        self.closed = True
+
+
+def test_iter_json_array_one_byte_chunks():
+    items = [0.5, -12, 1e5, -2.5E-3, 10, "a,]b", {"k": [1, 2.25]}, True, None, []]
+    body = ' [ ' + ' , '.join(mq.json.dumps(item) for item in items) + ' ] '
+
+    for size in (1, 2, 3, len(body)):
+        response = ChunkedResponse(body, size)
+        assert list(mq.iterJsonArray_util(response)) == items
+        assert response.closed
+
+
+def test_iter_json_array_number_at_chunk_boundary():
+    assert list(mq.iterJsonArray_util(ChunkedResponse('[0.5]', 2))) == [0.5]
+    assert list(mq.iterJsonArray_util(ChunkedResponse('[1e10,-3]', 2))) == [1e10, -3]
+    assert list(mq.iterJsonArray_util(ChunkedResponse('[]', 1))) == []
+
+
+def test_bounded_map_streams_results_in_order():
+    consumed = []
+
+    def items():
+        for number in range(20):
+            consumed.append(number)
+            yield number
+
+    with mq.ThreadPoolExecutor(max_workers=2) as executor:
+        results = mq.boundedMap_util(executor, lambda number: number * 2, items(), 4)
+        assert next(results) == 0
+        assert len(consumed) <= 4
+        assert list(results) == [number * 2 for number in range(1, 20)]
+
+
+def test_plan_prune_unbinds_pruned_exchange_first(monkeypatch):
+    desired = {('queue', 'queue-a'): {'kind': 'queue', 'item': {'queueId': 'queue-a'}}}
+    live = ({'queue-a': {'queueId': 'queue-a'}, 'queue-b': {'queueId': 'queue-b'}},
+            {'exchange-a': {'exchangeId': 'exchange-a'}},
+            {('exchange-a', 'queue-a'), ('exchange-a', 'queue-b')})
+    monkeypatch.setattr(mq, 'loadImportGraph_util', lambda confPath: desired)
+    monkeypatch.setattr(mq, 'loadLiveState_util', lambda client, concurrency, backend: live)
+    client = types.SimpleNamespace(region='us-east-1', orgId='org', envId='env')
+
+    kept = mq.planChanges_util(client, 'conf')
+    assert kept['changes'] == []
+
+    pruned = mq.planChanges_util(client, 'conf', prune=True)
+    assert pruned['summary'] == {'unbind': 2, 'delete-exchange': 1, 'delete-queue': 1}
+    graph = mq.planGraph_util(pruned['changes'])
+    assert sorted(graph[('delete-exchange', 'exchange-a')]['deps']) == [('unbind', 'exchange-a', 'queue-a'), ('unbind', 'exchange-a', 'queue-b')]
+    assert ('unbind', 'exchange-a', 'queue-b') in graph[('delete-queue', 'queue-b')]['deps']
+
+
+def test_find_queue_names_file_returns_map(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(mq, 'login', lambda username, password: 'token')
+    monkeypatch.setattr(mq, 'listDestinations_util', lambda client, noCache=False, refresh=False: [{'type': 'queue', 'queueId': 'queue-a'}])
+    namesFile = tmp_path / 'names.txt'
+    namesFile.write_text('queue-a\n')
+    common = ['--username', 'u', '--password', 'p', '--region', 'us-east-1', '--organization-id', 'org', '--environment-id', 'env']
+
+    result = CliRunner().invoke(mq.cli, ['find-queue'] + common + ['--names-file', str(namesFile)])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output) == {'queue-a': True}
+
+    result = CliRunner().invoke(mq.cli, ['find-queue'] + common + ['--name', 'queue-a', '--name', 'queue-b'])
+    assert json.loads(result.output) == {'queue-a': True, 'queue-b': False}
+
+
+def test_util_functions_run_on_either_transport():
+    class SyncClient:
+        def send(self, spec):
+            return spec
+
+    class AsyncClient:
+        async def send(self, spec):
+            return spec
+
+    change = {"action": "unbind", "exchange": "exchange-a", "queue": "queue-a"}
+    spec = mq.runChange_util(SyncClient(), change)
+    assert spec['method'] == 'DELETE' and spec['path'] == '/bindings/exchanges/exchange-a/queues/queue-a'
+    assert asyncio.run(mq.runChange_util(AsyncClient(), change)) == spec
+
+
+def test_stats_keeps_rows_when_a_destination_fails(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(mq, 'login', lambda username, password: 'token')
+    monkeypatch.setattr(mq, 'listDestinations_util', lambda client, noCache=False, refresh=False: [
+        {'type': 'queue', 'queueId': 'queue-a'}, {'type': 'queue', 'queueId': 'queue-b'}, {'type': 'exchange', 'exchangeId': 'exchange-a'}])
+    fetched = []
+    broken = {'queue-b'}
+
+    def destinationStats(client, kind, name, window):
+        fetched.append(name)
+        if name in broken:
+            raise Exception('HTTP error occurred: 404')
+        return {'type': kind, 'name': name, 'depth': 1}
+
+    monkeypatch.setattr(mq, 'destinationStats_util', destinationStats)
+    args = ['stats', '--username', 'u', '--password', 'p', '--region', 'us-east-1', '--organization-id', 'org', '--environment-id', 'env',
+        '--type', 'queue', '--format', 'ndjson']
+
+    result = CliRunner().invoke(mq.cli, args)
+    assert result.exit_code != 0
+    assert [json.loads(line) for line in result.output.splitlines()] == [
+        {'type': 'queue', 'name': 'queue-a', 'depth': 1}, {'type': 'queue', 'name': 'queue-b', 'error': 'HTTP error occurred: 404'}]
+    assert sorted(fetched) == ['queue-a', 'queue-b']
+
+    #### The snapshot answers the rows that succeeded, only the failed destination is fetched again ####
+    broken.clear()
+    result = CliRunner().invoke(mq.cli, args)
+    assert result.exit_code == 0, result.output
+    assert len(result.output.splitlines()) == 2
+    assert fetched[2:] == ['queue-b']
+
+
+def test_delete_queue_match_skips_dead_letter_queue_in_use(monkeypatch, capsys):
+    monkeypatch.setattr(mq, 'listDestinations_util', lambda client, noCache=False, refresh=False: [
+        {'type': 'queue', 'queueId': 'orders-dlq'}, {'type': 'queue', 'queueId': 'orders-old', 'deadLetterQueueId': 'orders-dlq'},
+        {'type': 'queue', 'queueId': 'payments', 'deadLetterQueueId': 'orders-dlq'}, {'type': 'queue', 'queueId': 'tmp-dlq'},
+        {'type': 'queue', 'queueId': 'tmp-a', 'deadLetterQueueId': 'tmp-dlq'}])
+    client = types.SimpleNamespace(region='us-east-1', orgId='org', envId='env')
+
+    mq.bulkChanges_util(client, 'delete-queue', ['orders-*', 'tmp-*'], False, True, 1)
+    out, err = capsys.readouterr()
+    changes = json.loads(out)['changes']
+    assert [change['name'] for change in changes] == ['orders-old', 'tmp-a', 'tmp-dlq']
+    assert 'orders-dlq' in err and 'payments' in err
+
+    graph = mq.planGraph_util(changes + [{"action": "delete-exchange", "name": "exchange-a"}])
+    assert graph[('delete-queue', 'tmp-dlq')]['deps'] == [('delete-queue', 'tmp-a')]
+    assert graph[('delete-queue', 'tmp-a')]['deps'] == []
+
+
+def test_find_exchange_single_name_returns_object(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(mq, 'login', lambda username, password: 'token')
+    monkeypatch.setattr(mq, 'listDestinations_util', lambda client, noCache=False, refresh=False: [{'type': 'exchange', 'exchangeId': 'exchange-a'}])
+    monkeypatch.setattr(mq, 'findDestination_util', lambda client, kind, name, noCache=False, refresh=False: {'exists': True, 'message': name + ' found'})
+    common = ['--username', 'u', '--password', 'p', '--region', 'us-east-1', '--organization-id', 'org', '--environment-id', 'env']
+
+    result = CliRunner().invoke(mq.cli, ['find-exchange'] + common + ['--name', 'exchange-a', '--name', 'exchange-a'])
+    assert json.loads(result.output) == {'exists': True, 'message': 'exchange-a found'}
+
+    result = CliRunner().invoke(mq.cli, ['find-exchange'] + common + ['--name', 'exchange-a,'])
+    assert json.loads(result.output) == {'exchange-a': True}
+
+
+def writeExport(path):
+    path.mkdir()
+    (path / 'queue-dlq_orders-dlq.json').write_text(json.dumps({'queueId': 'orders-dlq'}))
+    (path / 'queue_orders.json').write_text(json.dumps({'queueId': 'orders', 'deadLetterQueueId': 'orders-dlq'}))
+    (path / 'exchange_events.json').write_text(json.dumps({'exchangeId': 'events', 'encrypted': False}))
+    (path / 'bindings_events.json').write_text(json.dumps([{'exchangeId': 'events', 'queueId': 'orders'}]))
+
+
+def test_import_journal_resume(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(mq, 'login', lambda username, password: 'token')
+    writeExport(tmp_path / 'conf')
+    created = []
+    broken = {'orders'}
+
+    def createImportItem(client, node):
+        name = node['item'].get('queueId') if node['kind'] == 'queue' else node['item'].get('exchangeId')
+        if node['kind'] == 'queue' and name in broken:
+            raise Exception('HTTP error occurred: 500')
+        created.append((node['kind'], name))
+        return {'success': True}
+
+    monkeypatch.setattr(mq, 'createImportItem_util', createImportItem)
+    args = ['import', '--username', 'u', '--password', 'p', '--region', 'us-east-1', '--organization-id', 'org', '--environment-id', 'env',
+        '--conf-path', str(tmp_path / 'conf')]
+
+    result = CliRunner().invoke(mq.cli, args)
+    assert result.exit_code != 0
+    assert 'bindings_events.json: skipped, depends on failed orders' in result.output
+    assert sorted(created) == [('exchange', 'events'), ('queue', 'orders-dlq')]
+    assert sorted(os.listdir(tmp_path)) == ['cache', 'conf']
+    assert len(os.listdir(tmp_path / 'cache' / 'mq' / 'journals')) == 1
+
+    #### A plain re-run does not wipe the failed items ####
+    broken.clear()
+    result = CliRunner().invoke(mq.cli, args)
+    assert result.exit_code != 0 and 'failed items' in str(result.exception)
+    assert len(created) == 2
+
+    result = CliRunner().invoke(mq.cli, args + ['--resume'])
+    assert result.exit_code == 0, result.output
+    assert created[2:] == [('queue', 'orders'), ('binding', 'events')]
+
+
+def test_token_cache_key_is_keyed_by_a_private_secret(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.delenv('MQ_TOKEN_CACHE_SECRET', raising=False)
+
+    key = mq.tokenCacheKey('user', 'password', 'https://anypoint')
+    assert key == mq.tokenCacheKey('user', 'password', 'https://anypoint')
+    assert key != 'mq:token:' + hashlib.sha256(b'https://anypoint\0user\0password').hexdigest()
+    assert os.stat(tmp_path / 'mq' / 'token.secret').st_mode & 0o777 == 0o600
+
+    monkeypatch.setenv('MQ_TOKEN_CACHE_SECRET', 'shared')
+    assert mq.tokenCacheKey('user', 'password', 'https://anypoint') != key
+
+
+def test_search_streams_the_json_array(monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(sys, 'stdout', out)
+    written = []
+
+    def listing(client, noCache=False, refresh=False):
+        for number in range(3):
+            written.append(out.getvalue())
+            yield {'type': 'queue', 'queueId': 'queue-' + str(number), 'fifo': number == 1}
+
+    monkeypatch.setattr(mq, 'listDestinations_util', listing)
+    mq.printJsonArray_util(mq.search_util(None))
+
+    expected = [{'name': 'queue-' + str(number), 'fifo': number == 1, 'exchange': False} for number in range(3)]
+    assert out.getvalue() == json.dumps(expected) + '\n'
+    assert written[2] == '[' + json.dumps(expected[0]) + ', ' + json.dumps(expected[1])
+
+
+class IndexResponse(ChunkedResponse):
+    """Stands for a /destinations listing response, or a 304 without body"""
+
+    def __init__(self, status, destinations=None, etag=None):
+        super().__init__(json.dumps(destinations or []), 16)
+        self.status_code = status
+        self.headers = {'ETag': etag} if etag else {}
+
+
+def test_destinations_index_ttl_and_etag_revalidation(monkeypatch, tmp_path):
+    listing = [{'type': 'queue', 'queueId': 'queue-a'}, {'type': 'exchange', 'exchangeId': 'exchange-a'}]
+    requests = []
+    responses = [IndexResponse(200, listing, '"v1"'), IndexResponse(304), IndexResponse(200, listing[:1], '"v2"')]
+
+    def httpRequest(method, url, headers=None, stream=False, **kwargs):
+        requests.append(headers.get('If-None-Match'))
+        return responses[len(requests) - 1]
+
+    monkeypatch.setattr(mq, 'httpRequest', httpRequest)
+    clock = [1000.0]
+    monkeypatch.setattr(mq.time, 'time', lambda: clock[0])
+    client = types.SimpleNamespace(headers={'Authorization': 'bearer token'}, baseUrl='https://anypoint/mq')
+    path = str(tmp_path / 'index.json')
+
+    assert mq.DestinationsIndex(path, 30).destinations(client) == listing
+    assert requests == [None]
+
+    #### Within the TTL a new invocation answers from the saved index ####
+    clock[0] += 29
+    assert mq.DestinationsIndex(path, 30).destinations(client) == listing
+    assert requests == [None]
+
+    #### Past the TTL the index is revalidated with its ETag, a 304 keeps it for another TTL ####
+    clock[0] += 2
+    assert mq.DestinationsIndex(path, 30).destinations(client) == listing
+    assert requests == [None, '"v1"']
+    clock[0] += 29
+    assert mq.DestinationsIndex(path, 30).destinations(client) == listing
+    assert len(requests) == 2
+
+    #### --refresh downloads the listing again without the ETag ####
+    assert mq.DestinationsIndex(path, 30).destinations(client, refresh=True) == listing[:1]
+    assert requests == [None, '"v1"', None]
+    assert json.load(open(path))['etag'] == '"v2"'
+
+
+def test_import_waves_order_dead_letter_queues_and_bindings(tmp_path):
+    writeExport(tmp_path / 'conf')
+
+    nodes = mq.loadImportGraph_util(str(tmp_path / 'conf'))
+    assert mq.importWaves_util(nodes) == [
+        [('exchange', 'events'), ('queue', 'orders-dlq')],
+        [('queue', 'orders')],
+        [('binding', 'events', 'orders')]]
+
+    nodes[('queue', 'orders-dlq')]['deps'] = [('queue', 'orders')]
+    with pytest.raises(Exception, match='Circular dead letter queue references'):
+        mq.importWaves_util(nodes)
+
+
+def test_import_journal_imports_changed_items_again(tmp_path):
+    path = str(tmp_path / 'journal.ndjson')
+    target = {'region': 'us-east-1', 'organizationId': 'org', 'environmentId': 'env'}
+    node = {'kind': 'queue', 'file': 'queue_orders.json', 'item': {'queueId': 'orders', 'defaultTtl': 1000}}
+
+    with mq.ImportJournal(path, target) as journal:
+        journal.record(node, None)
+
+    with mq.ImportJournal(path, target, resume=True) as journal:
+        assert journal.isDone(node)
+        assert not journal.isDone(dict(node, item=dict(node['item'], defaultTtl=2000)))
+
+    with mq.ImportJournal(path, dict(target, region='eu-west-1'), resume=True) as journal:
+        assert not journal.isDone(node)
+
+
+def test_apply_runs_waves_and_skips_failed_dependencies(tmp_path, capsys):
+    sent = []
+
+    class Client:
+        index = mq.DestinationsIndex(str(tmp_path / 'index.json'), 0)
+
+        def send(self, spec):
+            sent.append(spec['method'] + ' ' + spec['path'])
+            if spec['path'] == '/bindings/exchanges/exchange-a/queues/queue-b':
+                raise Exception('HTTP error occurred: 500')
+            return {'success': True, 'message': 'done'}
+
+    changes = [
+        {'action': 'delete-queue', 'name': 'queue-dlq'},
+        {'action': 'delete-queue', 'name': 'queue-a', 'deadLetterQueueId': 'queue-dlq'},
+        {'action': 'delete-queue', 'name': 'queue-b'},
+        {'action': 'delete-exchange', 'name': 'exchange-a'},
+        {'action': 'unbind', 'exchange': 'exchange-a', 'queue': 'queue-a'},
+        {'action': 'unbind', 'exchange': 'exchange-a', 'queue': 'queue-b'}]
+
+    with pytest.raises(Exception, match='3 of 6 changes failed'):
+        mq.applyChanges_util(Client(), changes, 4, 0)
+
+    assert sorted(sent[:2]) == ['DELETE /bindings/exchanges/exchange-a/queues/queue-a', 'DELETE /bindings/exchanges/exchange-a/queues/queue-b']
+    assert sent[2:] == ['DELETE /destinations/queues/queue-a', 'DELETE /destinations/queues/queue-dlq']
+    results = {(result['action'], result.get('name', result.get('queue'))): result for result in map(json.loads, capsys.readouterr().out.splitlines()[:-1])}
+    assert results[('delete-exchange', 'exchange-a')]['message'] == 'skipped, depends on failed unbind exchange-a queue-b'
+    assert results[('delete-queue', 'queue-b')]['success'] is False
+    assert results[('delete-queue', 'queue-dlq')]['success'] is True
+
+
+class Broker:
+    """Stands for a BrokerClient, publishes fail for the message ids in <failing>"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.published = []
+        self.acked = []
+        self.lock = mq.threading.Lock()
+
+    def request(self, method, path, payload=None, params=None):
+        with self.lock:
+            (self.published if method == 'PUT' else self.acked).append([message['messageId'] for message in payload])
+        statuses = [{'messageId': message['messageId'], 'status': 'failed' if message['messageId'] in self.failing else 'successful'} for message in payload]
+        return types.SimpleNamespace(json=lambda: statuses)
+
+
+def test_publish_batches_lines_and_reports_failures(capsys):
+    broker = Broker(failing={'bad'})
+    lines = ['{"body": "a", "messageId": "m1"}', 'not json', '', '{"body": {"k": 1}, "messageId": "m4"}', '"plain"', '{"body": "e", "messageId": "bad"}']
+
+    with pytest.raises(Exception, match='2 of 5 messages failed'):
+        mq.publishLines_util(broker, 'orders', iter(lines), 2, 2)
+
+    assert [batch for batch in broker.published if 'm1' in batch or 'bad' in batch] == [['m1'], ['bad']]
+    assert sorted(len(batch) for batch in broker.published) == [1, 1, 2]
+    out = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(result['line'], result['success']) for result in out[:-1]] == [(2, False), (6, False)]
+    assert out[1]['message'] == 'failed'
+    assert out[-1]['published'] == 3 and out[-1]['failed'] == 2 and out[-1]['destination'] == 'orders'
+
+
+def test_message_from_line():
+    assert mq.messageFromLine_util('{"body": {"k": 1}, "messageId": "m1", "properties": {"p": "v"}}') == {
+        'messageId': 'm1', 'body': '{"k": 1}', 'properties': {'p': 'v'}}
+    message = mq.messageFromLine_util('"plain"')
+    assert message['body'] == 'plain' and message['messageId']
+
+
+def test_redrive_cursor_resume_does_not_publish_twice(tmp_path):
+    path = str(tmp_path / 'redrive' / 'cursor.ndjson')
+    messages = [{'headers': {'messageId': 'm' + str(number), 'lockId': 'l' + str(number)}, 'body': 'b'} for number in range(3)]
+
+    #### m2 fails to publish: it is neither recorded nor acknowledged ####
+    broker = Broker(failing={'m2'})
+    with mq.RedriveCursor(path) as cursor:
+        assert mq.redriveBatch_util(broker, 'orders-dlq', 'orders', messages, cursor, None) == {'m2': 'failed'}
+    assert broker.published == [['m0', 'm1', 'm2']]
+    assert broker.acked == [['m0', 'm1']]
+
+    #### After a crash before the ack, the redelivered m0 and m1 are only acknowledged ####
+    broker = Broker()
+    with mq.RedriveCursor(path, resume=True) as cursor:
+        assert cursor.isMoved('m0') and cursor.isMoved('m1') and not cursor.isMoved('m2')
+        assert mq.redriveBatch_util(broker, 'orders-dlq', 'orders', messages, cursor, None) == {}
+    assert broker.published == [['m2']]
+    assert broker.acked == [['m0', 'm1', 'm2']]
+
+    #### Without resume the cursor starts over ####
+    with mq.RedriveCursor(path) as cursor:
+        assert not cursor.isMoved('m0')
+
+
+def test_token_refresh_is_single_flight(monkeypatch, tmp_path):
+    monkeypatch.setattr(mq, '_tokenCache', mq.FileTokenCache(str(tmp_path / 'tokens.json')))
+    monkeypatch.setattr(mq, '_memoryTokenCache', mq.MemoryTokenCache())
+    fetched = []
+
+    def fetch():
+        fetched.append(1)
+        mq.time.sleep(0.2)
+        return 'token', 3600
+
+    with mq.ThreadPoolExecutor(max_workers=8) as executor:
+        tokens = list(executor.map(lambda _: mq.cachedToken_util('mq:token:key', fetch), range(8)))
+
+    assert tokens == ['token'] * 8
+    assert len(fetched) == 1
+    assert mq.FileTokenCache(str(tmp_path / 'tokens.json')).get('mq:token:key') == 'token'